@@ -7,13 +7,48 @@ sys.path.append(os.path.join(binary_path, ".."))
 from optparse import OptionParser
 import keynote.utils
 from keynote import keynote
+from keynote.output import create_output
 
 def parse_options(*args):
     parser = OptionParser()
-    parser.add_option("-o", "--output", dest="output", default="output.pdf",
-                      action="store", help="Output file")
+    parser.add_option("-o", "--output", dest="outputs", default=[],
+                      action="append", help="Output file (.pdf, .png or .svg; "
+                      "may be given more than once)")
+    parser.add_option("-f", "--format", dest="format", default=None,
+                      action="store", help="Output format (pdf, png or svg). "
+                      "Default: determined from the output file name")
+    parser.add_option("-d", "--dpi", dest="dpi", default=72, type="int",
+                      action="store", help="Resolution of png output")
+    parser.add_option("-b", "--bands", dest="bands", default=1, type="int",
+                      action="store", help="Number of threads to render each "
+                      "png image with")
+    parser.add_option("--max-complexity", dest="max_complexity", default=None,
+                      type="int", action="store", help="Rasterize slides "
+                      "with more drawing operations than this in pdf and svg output")
+    parser.add_option("--flatten-dpi", dest="flatten_dpi", default=150, type="int",
+                      action="store", help="Resolution of rasterized slides")
+    parser.add_option("--slide-timeout", dest="slide_timeout", default=None,
+                      type="float", action="store", help="Seconds after which "
+                      "rendering a slide is given up, and a placeholder is drawn")
+    parser.add_option("--slide-max-mem", dest="slide_max_mem", default=None,
+                      type="int", action="store", help="Megabytes of images a "
+                      "slide may use before a placeholder is drawn instead")
+    parser.add_option("-t", "--thumbnails-only", dest="thumbnails_only",
+                      default=False, action="store_true", help="Don't render "
+                      "the slides, but save the thumbnails stored with them")
+    parser.add_option("--thumbnail-size", dest="thumbnail_size", default=None,
+                      type="int", action="store", help="Scale thumbnails "
+                      "down to at most this width and height")
+    parser.add_option("--layout-cache", dest="layout_cache", default=None,
+                      action="store", help="Directory to keep text layouts "
+                      "in, for reuse by later conversions")
+    parser.add_option("--font-dir", dest="font_dir", default=None,
+                      action="store", help="Only use the fonts in this "
+                      "directory (see fontface.use_bundled_fonts())")
     parser.add_option("-p", "--pages", dest="pages", default="1-",
                       action="store", help="Pages to convert")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                      action="store", help="Number of processes to render with")
     opts,files = parser.parse_args(*args)
     if len(files) == 0:
         raise RuntimeError("missing file argument")
@@ -27,5 +62,31 @@ if __name__ == "__main__":
 
     keynote.set_options(opts)
 
+    if opts.thumbnails_only:
+        key = keynote.Keynote(filename, mode=keynote.THUMBNAILS)
+        size = None
+        if opts.thumbnail_size:
+            size = (opts.thumbnail_size, opts.thumbnail_size)
+        try:
+            for output in opts.outputs or ["slide-%d.png"]:
+                keynote.utils.check_pattern(output, len(key.selected_thumbnails()))
+        except ValueError as e:
+            sys.exit("key2pdf: %s" % e)
+        for output in opts.outputs or ["slide-%d.png"]:
+            key.save_thumbnails(output, size)
+        sys.exit(0)
+
     key = keynote.Keynote(filename)
-    key.save(opts.output)
+    if opts.format in (None, "pdf"):
+        default_output = "output.pdf"
+    else:
+        default_output = "slide-%%d.%s" % opts.format
+    outputs = [create_output(filename, opts.format,
+                             dpi=opts.dpi, bands=opts.bands)
+               for filename in opts.outputs or [default_output]]
+    try:
+        for output in outputs:
+            output.check_filename(len(key.selected_slides()))
+    except ValueError as e:
+        sys.exit("key2pdf: %s" % e)
+    key.save_as(outputs, jobs=opts.jobs)
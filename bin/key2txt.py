@@ -0,0 +1,36 @@
+#!/usr/bin/python
+import os
+import sys
+binary_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(binary_path, ".."))
+
+import json
+from optparse import OptionParser
+import keynote.utils
+from keynote import keynote
+
+def parse_options(*args):
+    parser = OptionParser()
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      action="store", help="Output file (default: stdout)")
+    parser.add_option("-p", "--pages", dest="pages", default="1-",
+                      action="store", help="Pages to extract")
+    opts,files = parser.parse_args(*args)
+    if len(files) == 0:
+        raise RuntimeError("missing file argument")
+    return opts,files
+
+if __name__ == "__main__":
+    keynote.utils.shorten_warnings()
+    opts,filenames = parse_options()
+
+    keynote.set_options(opts)
+
+    fo = open(opts.output, "w") if opts.output else sys.stdout
+    for filename in filenames:
+        key = keynote.Keynote(filename, mode=keynote.TEXT)
+        for slide in key.extract_text():
+            slide["file"] = filename
+            fo.write(json.dumps(slide) + "\n")
+    if fo is not sys.stdout:
+        fo.close()
@@ -0,0 +1,111 @@
+class Device(object):
+    """ Wrapper around a cairo.Context that keeps track of the current font,
+        source color and line style, and skips calls that wouldn't change
+        them. Every other method is passed through to the context.
+
+        Only changes made through this wrapper are tracked, so don't mix
+        calls to the wrapper with calls to the wrapped context.
+    """
+    STATE = ("font_face", "font_size", "source", "line_width",
+             "line_join", "line_cap", "miter_limit")
+
+    def __init__(self, context):
+        self.context = context
+        self._stack = []
+        self._reset()
+
+    def _reset(self):
+        for name in Device.STATE:
+            setattr(self, name, None)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def set_font_face(self, face):
+        if face is not self.font_face:
+            self.context.set_font_face(face)
+            self.font_face = face
+
+    def select_font_face(self, *args):
+        self.context.select_font_face(*args)
+        self.font_face = None
+
+    def set_font_size(self, size):
+        if size != self.font_size:
+            self.context.set_font_size(size)
+            self.font_size = size
+
+    def set_font_matrix(self, matrix):
+        self.context.set_font_matrix(matrix)
+        self.font_size = None
+
+    def set_scaled_font(self, scaled_font):
+        self.context.set_scaled_font(scaled_font)
+        self.font_face = None
+        self.font_size = None
+
+    def set_source_rgba(self, r, g, b, a=1.0):
+        color = (r, g, b, a)
+        if color != self.source:
+            self.context.set_source_rgba(r, g, b, a)
+            self.source = color
+
+    def set_source_rgb(self, r, g, b):
+        self.set_source_rgba(r, g, b, 1.0)
+
+    def set_source(self, source):
+        self.context.set_source(source)
+        self.source = None
+
+    def set_source_surface(self, surface, x=0.0, y=0.0):
+        self.context.set_source_surface(surface, x, y)
+        self.source = None
+
+    def set_line_width(self, width):
+        if width != self.line_width:
+            self.context.set_line_width(width)
+            self.line_width = width
+
+    def set_line_join(self, join):
+        if join != self.line_join:
+            self.context.set_line_join(join)
+            self.line_join = join
+
+    def set_line_cap(self, cap):
+        if cap != self.line_cap:
+            self.context.set_line_cap(cap)
+            self.line_cap = cap
+
+    def set_miter_limit(self, limit):
+        if limit != self.miter_limit:
+            self.context.set_miter_limit(limit)
+            self.miter_limit = limit
+
+    def save(self):
+        self.context.save()
+        self._save_state()
+
+    def restore(self):
+        self.context.restore()
+        self._restore_state()
+
+    def push_group(self):
+        # push_group() implies a save()
+        self.context.push_group()
+        self._save_state()
+
+    def pop_group(self):
+        self._restore_state()
+        return self.context.pop_group()
+
+    def pop_group_to_source(self):
+        self._restore_state()
+        self.context.pop_group_to_source()
+        self.source = None
+
+    def _save_state(self):
+        self._stack.append([getattr(self, name) for name in Device.STATE])
+
+    def _restore_state(self):
+        for name,value in zip(Device.STATE, self._stack.pop()):
+            setattr(self, name, value)
@@ -1,10 +1,29 @@
+import os
+import json
+import hashlib
+from xml.sax.saxutils import escape as xml_escape
 import ctypes
 from ctypes import c_int, c_void_p, c_char_p
 import cairo
+import logging
 from functools import lru_cache
 
+warn = logging.getLogger('keynote').warn
+
 NULL = c_void_p() 
 FT_ERR_OK = 0
+
+class FT_FaceRec(ctypes.Structure):
+    """ The first fields of FreeType's FT_FaceRec """
+    _fields_ = [("num_faces", ctypes.c_long),
+                ("face_index", ctypes.c_long),
+                ("face_flags", ctypes.c_long),
+                ("style_flags", ctypes.c_long),
+                ("num_glyphs", ctypes.c_long),
+                ("family_name", c_char_p),
+                ("style_name", c_char_p),
+               ]
+
 class Freetype:
     """ Interface to Freetype, using ctypes. """
     def __init__(self):
@@ -16,9 +35,14 @@ class Freetype:
         if self._initialized:
             return
         self.so = ctypes.CDLL("libfreetype.so.6")
+        self.so.FT_New_Face.argtypes = [c_void_p, c_char_p, ctypes.c_long, ctypes.POINTER(c_void_p)]
+        self.so.FT_New_Memory_Face.argtypes = [c_void_p, c_void_p, ctypes.c_long,
+                                               ctypes.c_long, ctypes.POINTER(c_void_p)]
+        self.so.FT_Done_Face.argtypes = [c_void_p]
         self._ft_lib = c_void_p()
         if FT_ERR_OK != self.so.FT_Init_FreeType(ctypes.byref(self._ft_lib)):
-            raise "Error initialising FreeType library."
+            raise Exception("Error initialising FreeType library.")
+        self._initialized = True
 
     def load_font(self, filename, faceindex=0):
         """ Load a font file from disk. 
@@ -27,19 +51,43 @@ class Freetype:
             Returns a ctypes void pointer. """
         self._initialize()
         ft_face = c_void_p()
-        filename_p = c_char_p(bytes(filename))
-        status = self.so.FT_New_Face(self._ft_lib, filename_p, faceindex, ctypes.byref(ft_face))
+        status = self.so.FT_New_Face(self._ft_lib, bytes(filename), faceindex, ctypes.byref(ft_face))
         if FT_ERR_OK != status:
-            raise Exception("Error creating FreeType font face for " + filename + ": "+str(status))
+            raise Exception("Error creating FreeType font face for %s: %d" % (filename, status))
         return ft_face
+
+    def load_memory_font(self, buffer, faceindex=0):
+        """ Load a font from a ctypes buffer. The buffer needs to be kept
+            around until the face is released with done_face(). """
+        self._initialize()
+        ft_face = c_void_p()
+        status = self.so.FT_New_Memory_Face(self._ft_lib, buffer, len(buffer), faceindex,
+                                            ctypes.byref(ft_face))
+        if FT_ERR_OK != status:
+            raise Exception("Error creating FreeType font face from memory: %d" % status)
+        return ft_face
+
+    def done_face(self, ft_face):
+        self.so.FT_Done_Face(ft_face)
+
+    def names(self, ft_face):
+        """ Returns the (family, style) of a face """
+        rec = ctypes.cast(ft_face, ctypes.POINTER(FT_FaceRec)).contents
+        family = rec.family_name.decode("utf-8", "replace") if rec.family_name else None
+        style = rec.style_name.decode("utf-8", "replace") if rec.style_name else None
+        return family, style
 _freetype = Freetype()
 
+DESTROY_FUNC = ctypes.CFUNCTYPE(None, c_void_p)
+
 class Cairo:
     """ Interface to Cairo fonts, using ctypes. """
     def __init__(self):
         """ Create a Cairo loader object. Initialization is lazy, and will
             happen with the first call to load() """
         self._initialized = False
+        # memory buffers of faces loaded with load_memory(), by face
+        self._buffers = {}
 
     def _initialize(self):
         if self._initialized:
@@ -49,6 +97,8 @@ class Cairo:
         self.so.cairo_ft_font_face_create_for_ft_face.argtypes = [c_void_p, ctypes.c_int]
         self.so.cairo_set_font_face.argtypes = [c_void_p, c_void_p]
         self.so.cairo_font_face_status.argtypes = [c_void_p]
+        self.so.cairo_font_face_destroy.argtypes = [c_void_p]
+        self.so.cairo_font_face_set_user_data.argtypes = [c_void_p, c_void_p, c_void_p, DESTROY_FUNC]
         self.so.cairo_status.argtypes = [c_void_p]
 
         class PycairoContext(ctypes.Structure):
@@ -57,30 +107,64 @@ class Cairo:
                     ("base", c_void_p)]
         self.PycairoContext = PycairoContext
 
+        # all faces are created through this one context
         self._surface = cairo.ImageSurface(cairo.FORMAT_A8, 0, 0)
+        self._context = cairo.Context(self._surface)
+        self._cairo_t = self.PycairoContext.from_address(id(self._context)).ctx
+        # cairo_user_data_key_t only needs a unique address
+        self._key = ctypes.c_int()
+        # must stay referenced as long as there are faces
+        self._destroy = DESTROY_FUNC(self._face_destroyed)
         self._initialized = True
 
-    def load(self, filename, loadoptions=0):
+    def _face_destroyed(self, ft_face):
+        """ Called by cairo when the last reference to a font face is gone """
+        _freetype.done_face(ft_face)
+        self._buffers.pop(ft_face, None)
+
+    def load(self, filename, faceindex=0, loadoptions=0):
         """ Load a font file. 
             Returns a cairo.FontFace object."""
         self._initialize()
+        return self._create(_freetype.load_font(filename, faceindex), loadoptions)
+
+    def load_memory(self, data, faceindex=0, loadoptions=0):
+        """ Load a font from a bytes object.
+            Returns (cairo.FontFace, family, style). """
+        self._initialize()
+        buffer = ctypes.create_string_buffer(data, len(data))
+        ft_face = _freetype.load_memory_font(buffer, faceindex)
+        self._buffers[ft_face.value] = buffer
+        family, style = _freetype.names(ft_face)
+        return self._create(ft_face, loadoptions), family, style
+
+    def _create(self, ft_face, loadoptions):
+        """ Wrap a FreeType face into a cairo.FontFace. The FreeType face
+            is released when cairo destroys the font face, i.e. once the
+            returned object and all scaled fonts using it are gone. """
         CAIRO_STATUS_SUCCESS = 0
-    
-        cairo_ctx = cairo.Context(self._surface)
-        cairo_t = self.PycairoContext.from_address(id(cairo_ctx)).ctx
-        
-        ft_face = _freetype.load_font(filename)
 
         # create cairo font face for freetype face
         cr_face = self.so.cairo_ft_font_face_create_for_ft_face(ft_face, loadoptions)
         if CAIRO_STATUS_SUCCESS != self.so.cairo_font_face_status(cr_face):
-            raise Exception("Error creating cairo font face for " + filename)
-
-        self.so.cairo_set_font_face(cairo_t, cr_face)
-        if CAIRO_STATUS_SUCCESS != self.so.cairo_status(cairo_t):
-            raise Exception("Error creating cairo font face for " + filename)
+            _freetype.done_face(ft_face)
+            self._buffers.pop(ft_face.value, None)
+            raise Exception("Error creating cairo font face")
+        if CAIRO_STATUS_SUCCESS != self.so.cairo_font_face_set_user_data(
+                cr_face, ctypes.byref(self._key), ft_face, self._destroy):
+            self.so.cairo_font_face_destroy(cr_face)
+            _freetype.done_face(ft_face)
+            self._buffers.pop(ft_face.value, None)
+            raise Exception("Error creating cairo font face")
 
-        face = cairo_ctx.get_font_face()
+        self.so.cairo_set_font_face(self._cairo_t, cr_face)
+        if CAIRO_STATUS_SUCCESS != self.so.cairo_status(self._cairo_t):
+            self.so.cairo_font_face_destroy(cr_face)
+            raise Exception("Error creating cairo font face")
+        face = self._context.get_font_face()
+        # the context and the returned object now hold the references
+        self.so.cairo_font_face_destroy(cr_face)
+        self._context.set_font_face(None)
         return face
 _cairo = Cairo()
 
@@ -89,6 +173,7 @@ FC_STYLE = "style".encode("ascii")
 FC_OUTLINE = "outline".encode("ascii")
 FC_SCALABLE = "scalable".encode("ascii")
 FC_FILE = "file".encode("ascii")
+FC_INDEX = "index".encode("ascii")
 # FcType
 FcTypeVoid = 0
 FcTypeInteger = 1
@@ -113,6 +198,18 @@ FcMatchPattern=0
 FcMatchFont=1
 FcMatchScan=2
 
+# font configuration for use_bundled_fonts(), if the font directory
+# doesn't have a fonts.conf. fontconfig writes its cache to the first
+# cache directory, and reads it from any of them.
+BUNDLED_FONTS_CONF = """<?xml version="1.0"?>
+<!DOCTYPE fontconfig SYSTEM "fonts.dtd">
+<fontconfig>
+  <dir>%s</dir>
+  <cachedir>%s</cachedir>
+  <cachedir>%s</cachedir>
+</fontconfig>
+"""
+
 class FontConfigError(Exception):
     pass
 class FcFontSet(ctypes.Structure):
@@ -127,12 +224,38 @@ class FontConfig:
         self.so= None
         self._fc_current = None
 
-    def _initialize(self):
-        if self._initialized:
+    def _load_library(self):
+        if self.so is not None:
             return
         self.so = ctypes.CDLL("libfontconfig.so")
         self.so.FcConfigGetCurrent.restype = c_void_p
-        self.so.FcFontSort.restype = ctypes.POINTER(FcFontSet)
+        self.so.FcPatternCreate.restype = c_void_p
+        self.so.FcObjectSetBuild.restype = c_void_p
+        self.so.FcFontList.restype = ctypes.POINTER(FcFontSet)
+        self.so.FcFontList.argtypes = [c_void_p, c_void_p, c_void_p]
+        self.so.FcFontMatch.restype = c_void_p
+        self.so.FcFontMatch.argtypes = [c_void_p, c_void_p, ctypes.POINTER(c_int)]
+        self.so.FcPatternAddString.argtypes = [c_void_p, c_char_p, c_char_p]
+        self.so.FcPatternGetString.argtypes = [c_void_p, c_char_p, c_int, ctypes.POINTER(c_char_p)]
+        self.so.FcPatternGetInteger.argtypes = [c_void_p, c_char_p, c_int, ctypes.POINTER(c_int)]
+        self.so.FcConfigGetFonts.argtypes = [c_void_p, c_int]
+        self.so.FcConfigCreate.restype = c_void_p
+        self.so.FcConfigParseAndLoad.argtypes = [c_void_p, c_char_p, c_int]
+        self.so.FcConfigParseAndLoadFromMemory.argtypes = [c_void_p, c_char_p, c_int]
+        self.so.FcConfigBuildFonts.argtypes = [c_void_p]
+        self.so.FcConfigSetCurrent.argtypes = [c_void_p]
+        self.so.FcInitLoadConfig.restype = c_void_p
+        self.so.FcConfigDestroy.argtypes = [c_void_p]
+        self.so.FcConfigGetFontDirs.restype = c_void_p
+        self.so.FcConfigGetFontDirs.argtypes = [c_void_p]
+        self.so.FcStrListNext.restype = c_char_p
+        self.so.FcStrListNext.argtypes = [c_void_p]
+        self.so.FcStrListDone.argtypes = [c_void_p]
+
+    def _initialize(self):
+        if self._initialized:
+            return
+        self._load_library()
         if not self.so.FcInit():
             raise FontConfigError("Couldn't initialize fontconfig")
         self._fc_current = self.so.FcConfigGetCurrent();
@@ -143,6 +266,34 @@ class FontConfig:
             raise FontConfigError("fontconfig doesn't have any fonts")
         self._initialized = True
 
+    def use_directory(self, directory):
+        """ Replace the system's font configuration by one that only knows
+            the fonts in the given directory. The configuration is read from
+            fonts.conf in the directory, if there is one. Otherwise, a
+            prebuilt font cache is read from the "fc-cache" subdirectory,
+            and if it's missing or out of date, fontconfig scans the
+            directory and writes its cache to font_cache_directory()
+            instead, so the directory itself can be read-only.
+        """
+        self._load_library()
+        config = self.so.FcConfigCreate()
+        conf_file = os.path.join(directory, "fonts.conf")
+        if os.path.exists(conf_file):
+            ok = self.so.FcConfigParseAndLoad(config, os.fsencode(conf_file), FcTrue)
+        else:
+            conf = BUNDLED_FONTS_CONF % (xml_escape(directory),
+                                         xml_escape(font_cache_directory(directory)),
+                                         xml_escape(os.path.join(directory, "fc-cache")))
+            ok = self.so.FcConfigParseAndLoadFromMemory(config, conf.encode("utf-8"), FcTrue)
+        if not ok:
+            raise FontConfigError("Couldn't load font configuration for %s" % directory)
+        if not self.so.FcConfigBuildFonts(config):
+            raise FontConfigError("Couldn't load fonts from %s" % directory)
+        if not self.so.FcConfigSetCurrent(config):
+            raise FontConfigError("Couldn't set font configuration for %s" % directory)
+        self._fc_current = config
+        self._initialized = True
+
     def add_font(self, filename):
         """ Adds a font to fontconfig. Fonts added this way will later
             be returned by find_font() if they match the requested pattern.
@@ -151,92 +302,399 @@ class FontConfig:
             call this method if you want to add your own set of custom
             fonts, e.g. for fonts embedded in document files.
         """
-        if not self.so.FcConfigAppFontAddFile(self._fc_current, filename.encode("ascii")):
-            raise FontConfigError("Failed to Add font file %s." % filename)
-
-    def find_font(self, family, style=None, faceindex=0):
-        """ Searches for a given font family, with the optional style.
-            This method will always return a font, regardless of how well
-            it matches a pattern. If it doesn't find a match for the specified
-            family, it will just match by style, or just return the default
-            font if that fails as well.
-        """
         self._initialize()
+        if not self.so.FcConfigAppFontAddFile(c_void_p(self._fc_current), filename.encode("utf-8")):
+            raise FontConfigError("Failed to Add font file %s." % filename)
+        _font_index.persistent = False
 
-        if style:
-            pattern = self.so.FcPatternBuild(NULL,
-                FC_OUTLINE, FcTypeBool, FcTrue,
-                FC_SCALABLE, FcTypeBool, FcTrue, 
-                FC_FAMILY, FcTypeString, family.encode("ascii"), 
-                FC_STYLE, FcTypeString, style, 
-                NULL)
+    def font_directories(self):
+        """ Returns the directories fontconfig loads fonts from (including
+            the user's, and those added in conf.d). Unless fontconfig is
+            initialized already, only its configuration is read for this,
+            not the fonts. """
+        self._load_library()
+        if self._initialized:
+            config = self._fc_current
         else:
-            pattern = self.so.FcPatternBuild(NULL,
-                FC_OUTLINE, FcTypeBool, FcTrue,
-                FC_SCALABLE, FcTypeBool, FcTrue, 
-                FC_FAMILY, FcTypeString, family.encode("ascii"), 
-                NULL)
+            config = self.so.FcInitLoadConfig()
+            if not config:
+                raise FontConfigError("Couldn't load the fontconfig configuration")
+        dirs = self.so.FcConfigGetFontDirs(config)
+        directories = []
+        while dirs:
+            directory = self.so.FcStrListNext(dirs)
+            if directory is None:
+                break
+            directories.append(os.fsdecode(directory))
+        if dirs:
+            self.so.FcStrListDone(dirs)
+        if not self._initialized:
+            self.so.FcConfigDestroy(config)
+        return directories
+
+    def _get_string(self, pattern, name):
+        value = c_char_p(0)
+        if self.so.FcPatternGetString(pattern, name, 0, ctypes.byref(value)) != FcResultMatch:
+            return None
+        return value.value.decode("utf-8")
 
+    def _get_integer(self, pattern, name):
+        value = c_int(0)
+        self.so.FcPatternGetInteger(pattern, name, 0, ctypes.byref(value))
+        return value.value
 
-        self.so.FcConfigSubstitute(0, pattern, FcMatchPattern); 
-        self.so.FcDefaultSubstitute(pattern);
+    def list_fonts(self):
+        """ Returns (family, style, filename, face index) for every font
+            fontconfig knows about. """
+        self._initialize()
+        pattern = self.so.FcPatternCreate()
+        objects = self.so.FcObjectSetBuild(FC_FAMILY, FC_STYLE, FC_FILE, FC_INDEX, NULL)
+        fcset_ptr = self.so.FcFontList(self._fc_current, pattern, objects)
+        fonts = []
+        if fcset_ptr:
+            fcset = fcset_ptr.contents
+            for i in range(fcset.nfonts):
+                m = fcset.fonts[i]
+                family = self._get_string(m, FC_FAMILY)
+                filename = self._get_string(m, FC_FILE)
+                if family is None or filename is None:
+                    continue
+                fonts.append((family, self._get_string(m, FC_STYLE) or "",
+                              filename, self._get_integer(m, FC_INDEX)))
+            self.so.FcFontSetDestroy(fcset_ptr)
+        self.so.FcObjectSetDestroy(c_void_p(objects))
+        self.so.FcPatternDestroy(c_void_p(pattern))
+        return fonts
 
-        result = 0
-        fcset_ptr = self.so.FcFontSort(NULL, pattern, c_int(1), NULL, NULL)
-        if not fcset_ptr:
-            self.so.FcPatternDestroy(pattern)
+    def match_font(self, family, style=None):
+        """ Returns (filename, face index) of the font fontconfig
+            substitutes for the given family and style. """
+        self._initialize()
+        pattern = self.so.FcPatternCreate()
+        self.so.FcPatternAddString(pattern, FC_FAMILY, family.encode("utf-8"))
+        if style:
+            self.so.FcPatternAddString(pattern, FC_STYLE, style.encode("utf-8"))
+        self.so.FcConfigSubstitute(c_void_p(self._fc_current), c_void_p(pattern), FcMatchPattern)
+        self.so.FcDefaultSubstitute(c_void_p(pattern))
+        result = c_int(0)
+        match = self.so.FcFontMatch(self._fc_current, pattern, ctypes.byref(result))
+        self.so.FcPatternDestroy(c_void_p(pattern))
+        if not match:
             return None
-        fcset = fcset_ptr.contents
-
-        filename = None
-        candidates = []
-        for i in range(fcset.nfonts):
-            m = fcset.fonts[i]
-            m_filename = c_char_p(0)
-            m_family = c_char_p(0)
-            m_style = c_char_p(0)
-            ok = self.so.FcPatternGetString(m, FC_FILE, c_int(0), ctypes.byref(m_filename))
-            ok |= self.so.FcPatternGetString(m, FC_FILE, c_int(0), ctypes.byref(m_family))
-            ok |= self.so.FcPatternGetString(m, FC_FILE, c_int(0), ctypes.byref(m_style))
-            if ok != FcResultMatch:
-                continue
-            candidates.append((m_filename.value, m_family.value, m_style.value))
-        self.so.FcPatternDestroy(pattern)
-
-        # try by family and style
-        for m_filename,m_family,m_style in candidates:
-            if m_family.lower() == family.lower() and m_style == style:
-                return m_filename
-        # try just by family
-        for m_filename,m_family,m_style in candidates:
-            if m_family.lower() == family.lower():
-                return m_filename
-        # try just by style
-        for m_filename,m_family,m_style in candidates:
-            if m_style == style:
-                return m_filename
-        # return "default" font
-        for m_filename,m_family,m_style in candidates:
-            return m_filename
+        font = (self._get_string(match, FC_FILE), self._get_integer(match, FC_INDEX))
+        self.so.FcPatternDestroy(c_void_p(match))
+        return font
 _font_config = FontConfig()
 
-@lru_cache()
+class FontIndex:
+    """ A font lookup table, stored on disk as JSON.
+        The index maps (family, style) to the file and face index of a font.
+        It is built once from all fonts fontconfig knows about, and rebuilt
+        whenever one of the font directories changes (by comparing their
+        modification times). Unless given, the directories are the ones
+        fontconfig is configured with. Fonts that aren't installed are looked up
+        with fontconfig (which picks a substitute), and the result is
+        stored in the index as well. Lookups are therefore dictionary hits,
+        and usually don't need to initialize fontconfig at all.
+    """
+    VERSION = 2
+
+    def __init__(self, filename, directories=None, font_config=None):
+        self.filename = filename
+        self.directories = directories
+        self.font_config = font_config or _font_config
+        self._loaded = False
+        # lookups of fonts that aren't in the index depend on fonts added
+        # with add_font(), so they're only kept in memory
+        self.persistent = True
+
+    def _stamp(self):
+        """ modification times of all font directories """
+        if self.directories is None:
+            self.directories = self.font_config.font_directories()
+        stamp = {}
+        for directory in self.directories:
+            for path,dirs,files in os.walk(directory):
+                stamp[path] = os.stat(path).st_mtime
+        return stamp
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        stamp = self._stamp()
+        try:
+            with open(self.filename) as fi:
+                data = json.load(fi)
+            if data["version"] == FontIndex.VERSION and data["stamp"] == stamp:
+                self.fonts = data["fonts"]
+                self.matches = data["matches"]
+                self._stamp_value = stamp
+                return
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self.build(stamp)
+
+    def build(self, stamp=None):
+        """ Rebuild the index from fontconfig """
+        self.fonts = {}
+        self.matches = {}
+        for family,style,filename,index in self.font_config.list_fonts():
+            self.fonts.setdefault(FontIndex.key(family, style), [filename, index])
+            # regular fonts are the default for a family
+            if style.lower() in ("regular", "normal", "book", "roman") or \
+               FontIndex.key(family) not in self.fonts:
+                self.fonts[FontIndex.key(family)] = [filename, index]
+        self._stamp_value = stamp if stamp is not None else self._stamp()
+        self.save()
+
+    def save(self):
+        if not self.persistent:
+            return
+        data = {"version": FontIndex.VERSION, "stamp": self._stamp_value,
+                "fonts": self.fonts, "matches": self.matches}
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmpfile = "%s.%d.tmp" % (self.filename, os.getpid())
+            with open(tmpfile, "w") as fo:
+                json.dump(data, fo)
+            os.rename(tmpfile, self.filename)
+        except (IOError, OSError):
+            pass # a read-only cache directory only costs us speed
+
+    @staticmethod
+    def key(family, style=None):
+        return family.lower() + "\t" + (style or "").lower()
+
+    def find(self, family, style=None):
+        """ Returns (filename, face index) for a family and optional style """
+        self._load()
+        key = FontIndex.key(family, style)
+        font = self.fonts.get(key) or self.matches.get(key)
+        if font is None:
+            font = self.fonts.get(FontIndex.key(family)) if style else None
+        if font is None:
+            font = self.font_config.match_font(family, style)
+            self.matches[key] = font
+            self.save()
+        return tuple(font) if font is not None else None
+
 def create_cairo_font_face_for_file(filename):
     """ returns a cairo font face for a font file. """
-    return _cairo.load(filename)
+    return _face_pool.get(filename)
+
+def font_index_filename(directory=None):
+    """ Where the font index for the system fonts (or for a directory of
+        bundled fonts) is stored """
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    if directory is not None:
+        name = hashlib.sha1(os.path.abspath(directory).encode("utf-8")).hexdigest()
+        return os.path.join(cache, "keynote", "font-index-%s.json" % name)
+    return os.environ.get("KEYNOTE_FONT_INDEX") or \
+           os.path.join(cache, "keynote", "font-index.json")
+
+def font_cache_directory(directory):
+    """ Where fontconfig writes its cache for a directory of bundled fonts """
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    name = hashlib.sha1(os.path.abspath(directory).encode("utf-8")).hexdigest()
+    return os.path.join(cache, "keynote", "fc-cache-%s" % name)
+_font_index = FontIndex(font_index_filename())
+# family names to use instead of the requested ones, see use_bundled_fonts()
+_substitutions = {}
+_bundled_directory = None
+
+def use_bundled_fonts(directory):
+    """ Only use the fonts in the given directory, instead of the system's
+        fonts, so that fonts resolve the same way on every host.
+        The directory can have a prebuilt fontconfig cache (see
+        FontConfig.use_directory()), and a file substitutions.json, which
+        maps font families that documents use to families in the
+        directory, e.g. {"Helvetica": "Liberation Sans"}. """
+    global _font_index, _substitutions, _bundled_directory
+    directory = os.path.abspath(directory)
+    if directory == _bundled_directory:
+        return
+    _font_config.use_directory(directory)
+    substitutions_file = os.path.join(directory, "substitutions.json")
+    _substitutions = {}
+    if os.path.exists(substitutions_file):
+        with open(substitutions_file) as fi:
+            _substitutions = {k.lower(): v for k,v in json.load(fi).items()}
+    _font_index = FontIndex(font_index_filename(directory), [directory])
+    _bundled_directory = directory
+    find_font.cache_clear()
+    release_fonts()
+
+class FacePool:
+    """ The cairo font faces of all fonts loaded so far, shared by all
+        documents processed by this process.
+        Fonts embedded in a document are loaded from memory, and are only
+        found by family name until release_embedded() is called. """
+    def __init__(self):
+        # cairo.FontFace by (filename, face index), or by content hash
+        self.faces = {}
+        # (cairo.FontFace, pseudo filename) of embedded fonts, by name
+        self.embedded = {}
+
+    def get(self, filename, index=0):
+        key = (filename, index)
+        if key not in self.faces:
+            self.faces[key] = _cairo.load(os.fsencode(filename), index)
+        return self.faces[key]
+
+    def add_embedded(self, data, name=None):
+        """ Load a font file from memory, and make it available under its
+            family name (and "family-style"). Returns the family name, or
+            None if the font can't be loaded. """
+        key = hashlib.sha1(data).hexdigest()
+        try:
+            face, family, style = _cairo.load_memory(data)
+        except Exception as e:
+            warn("Couldn't load embedded font %s: %s" % (name or key, e))
+            return None
+        if family is None:
+            return None
+        self.faces[key] = face
+        names = [family]
+        if style:
+            names.append(family + "-" + style.replace(" ", ""))
+        for name in names:
+            self.embedded[name.lower()] = (face, "embedded:" + key)
+        return family
+
+    def find_embedded(self, name):
+        """ Returns (cairo.FontFace, pseudo filename) of an embedded font,
+            or None """
+        if not self.embedded:
+            return None
+        font = self.embedded.get(name.lower())
+        if font is None and "-" in name:
+            font = self.embedded.get(name[0:name.find("-")].lower())
+        return font
+
+    def release_embedded(self):
+        """ Forget all embedded fonts, so their memory gets freed """
+        keys = set(filename[len("embedded:"):] for face,filename in self.embedded.values())
+        self.embedded = {}
+        for key in keys:
+            self.faces.pop(key, None)
+        clear_caches()
+
+    def release(self):
+        """ Forget all fonts, so their FreeType faces get freed """
+        self.faces = {}
+        self.embedded = {}
+        clear_caches()
+_face_pool = FacePool()
+
+def add_embedded_font(data, name=None):
+    """ Make a font from a document available by its family name.
+        Returns the family name, or None if the font couldn't be read
+        (in which case documents fall back to the system's fonts). """
+    return _face_pool.add_embedded(data, name)
+
+def release_embedded_fonts():
+    _face_pool.release_embedded()
+
+def release_fonts():
+    """ Release all fonts. FreeType faces are freed as soon as cairo no
+        longer uses them. """
+    _face_pool.release()
 
 @lru_cache()
-def find_cairo_font(name):
-    """ Tries to find the font with the given name using fontconfig,
-        and if successful, returns a cairo fontface object that 
-        contains the font."""
+def find_font(name):
+    """ Returns (filename, face index) of the font with the given name,
+        or of the font fontconfig substitutes for it """
     if "-" in name:
         name = name[0:name.find("-")]
-    path = _font_config.find_font(name)
-    return _cairo.load(path)
+    name = _substitutions.get(name.lower(), name)
+    return _font_index.find(name)
+
+def find_font_file(name):
+    """ Returns the font file for the font with the given name """
+    embedded = _face_pool.find_embedded(name)
+    if embedded is not None:
+        return embedded[1]
+    return find_font(name)[0]
+
+def find_cairo_font(name):
+    """ Tries to find the font with the given name (see find_font()),
+        and if successful, returns a cairo fontface object that 
+        contains the font. Fonts embedded in the current document are
+        preferred. """
+    embedded = _face_pool.find_embedded(name)
+    if embedded is not None:
+        return embedded[0]
+    filename, index = find_font(name)
+    return _face_pool.get(filename, index)
+
+@lru_cache(maxsize=256)
+def get_scaled_font(face, size):
+    """ returns a cairo scaled font for a font face and size.
+        Metrics are not hinted, so text measures the same on every surface
+        type and at every resolution. """
+    options = cairo.FontOptions()
+    options.set_hint_metrics(cairo.HINT_METRICS_OFF)
+    return cairo.ScaledFont(face, cairo.Matrix(xx=size, yy=size),
+                            cairo.Matrix(), options)
+
+@lru_cache(maxsize=256)
+def font_extents(face, size):
+    """ returns (ascent, descent, height, max_x_advance, max_y_advance)
+        of a font face at the given size """
+    return get_scaled_font(face, size).extents()
+
+@lru_cache(maxsize=65536)
+def text_extents(face, size, text):
+    """ returns (x_bearing, y_bearing, width, height, x_advance, y_advance)
+        of a string in a font face at the given size, like
+        cairo.Context.text_extents(). Results are cached for all documents
+        processed by this process. """
+    return get_scaled_font(face, size).text_extents(text)
+
+@lru_cache(maxsize=65536)
+def text_glyphs(face, size, text):
+    """ returns the glyphs of a string in a font face at the given size, as
+        (index, x, y) tuples with the string starting at (0,0), like
+        cairo.ScaledFont.text_to_glyphs(). Results are cached like those of
+        text_extents(). """
+    return tuple(get_scaled_font(face, size).text_to_glyphs(0, 0, text, False))
+
+class CachedScaledFont(object):
+    """ Stands in for the cairo.ScaledFont of a font face and size when
+        laying out text (see layout.layout_text()), and takes its
+        measurements from the caches of text_glyphs() and text_extents() """
+    def __init__(self, face, size):
+        self.face = face
+        self.size = size
+
+    def text_to_glyphs(self, x, y, text, with_clusters=False):
+        glyphs = text_glyphs(self.face, self.size, text)
+        if x or y:
+            glyphs = tuple((index, gx + x, gy + y) for index,gx,gy in glyphs)
+        return glyphs
+
+    def text_extents(self, text):
+        return text_extents(self.face, self.size, text)
+
+def clear_caches():
+    """ Drop all scaled fonts and measurements, which reference font faces """
+    get_scaled_font.cache_clear()
+    font_extents.cache_clear()
+    text_extents.cache_clear()
+    text_glyphs.cache_clear()
+
+def cache_info():
+    """ returns hit/miss statistics of the font caches """
+    return {"scaled_fonts": get_scaled_font.cache_info(),
+            "font_extents": font_extents.cache_info(),
+            "text_extents": text_extents.cache_info(),
+            "text_glyphs": text_glyphs.cache_info()}
 
 if __name__ == "__main__":
-    path = _font_config.find_font("Arial")
+    path = find_font_file("Arial")
     if path is None:
         import sys
         sys.exit(1)
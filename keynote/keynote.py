@@ -3,13 +3,32 @@ from contextlib import contextmanager
 import sys
 import logging
 from . import utils
-from PIL import Image
-from .xml import XML, ns
-import cairo
+from .xml import Element, XMLStream, collect_references, ns
 import os
+import math
+import time
 from io import StringIO, BytesIO
-import numpy
-from .fontface import find_cairo_font
+import multiprocessing
+from .device import Device
+# cairo, PIL, numpy and the modules using them are imported by
+# load_rendering_modules()
+
+def load_rendering_modules():
+    """ Import everything that's needed for rendering slides and reading
+        images. This is only done for documents that aren't loaded in TEXT
+        mode, so that text can be extracted without cairo, PIL, numpy,
+        fontconfig or FreeType installed. """
+    global cairo, numpy, Image, find_cairo_font, find_font_file, \
+           CachedScaledFont, font_extents, add_embedded_font, \
+           release_embedded_fonts, use_bundled_fonts, layout_text, \
+           LayoutResult, LayoutCache, PDFOutput
+    import cairo
+    import numpy
+    from PIL import Image
+    from .fontface import find_cairo_font, find_font_file, CachedScaledFont, font_extents, \
+                          add_embedded_font, release_embedded_fonts, use_bundled_fonts
+    from .layout import layout_text, LayoutResult, LayoutCache
+    from .output import PDFOutput
 
 class Options:
     settings = { 
@@ -26,24 +45,181 @@ def set_options(o):
     for n in dir(o):
         Options.settings[n] = getattr(o,n)
 
+def get_settings():
+    """ returns a copy of the current settings that can be sent to
+        another process """
+    return {k:v for k,v in Options.settings.items()
+            if not k.startswith("_") and not callable(v)}
+
 info = logging.getLogger('keynote').info
 warn = logging.getLogger('keynote').warn
 
+# what a Keynote is loaded for: in THUMBNAILS mode, slides aren't parsed
+# (only the paths of their thumbnail images are).
+RENDER = "render"
+THUMBNAILS = "thumbnails"
+# in TEXT mode, slides are parsed, but master slides aren't
+TEXT = "text"
+
+# files in the archive that are loaded as embedded fonts
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+
+# see Slide.complexity()
+IMAGE_PIXELS_PER_OPERATION = 1000
+# resolution of slides that are too complex for vector output
+DEFAULT_FLATTEN_DPI = 150
+
 class AssumptionError(Exception):
     pass
 
+class BudgetExceeded(Exception):
+    pass
+
+class Budget(object):
+    """ Time and memory limits for rendering a single slide.
+        The limits are checked between drawables, and before images are
+        decoded, so a single drawing operation can still overrun them.
+        A slide is charged for every image it uses, also if the image was
+        already decoded (for another slide, or before rendering started),
+        but only once per image. A slide may use exactly max_mem bytes. """
+    current = None
+
+    def __init__(self, timeout=None, max_mem=None):
+        self.deadline = time.time() + timeout if timeout else None
+        self.max_mem = max_mem
+        self.used = 0
+        self.charged = set()
+
+    def check(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise BudgetExceeded("time limit exceeded")
+
+    def allocate(self, size, key=None):
+        """ Charge size bytes. If a key is given, only the first allocation
+            with that key is charged. """
+        if key is not None:
+            if key in self.charged:
+                return
+            self.charged.add(key)
+        self.used += size
+        if self.max_mem is not None and self.used > self.max_mem:
+            raise BudgetExceeded("memory limit exceeded (%d bytes)" % self.used)
+
+    @staticmethod
+    def check_current():
+        if Budget.current is not None:
+            Budget.current.check()
+
+    @staticmethod
+    def allocate_current(size, key=None):
+        if Budget.current is not None:
+            Budget.current.check()
+            Budget.current.allocate(size, key)
+
+    @staticmethod
+    def enabled():
+        return bool(options.slide_timeout or options.slide_max_mem)
+
+    @staticmethod
+    def guard(slide, render):
+        """ Returns a render function that renders a slide within the budget
+            given by the slide_timeout (seconds) and slide_max_mem
+            (megabytes) options. The slide is rendered into a recording
+            first, so that if it exceeds the budget, nothing of it gets drawn
+            but a placeholder. """
+        def render_within_budget(device):
+            width, height = Index.current.width, Index.current.height
+            max_mem = options.slide_max_mem
+            Budget.current = Budget(options.slide_timeout,
+                                    max_mem * 1024 * 1024 if max_mem else None)
+            try:
+                recording = record(render, width, height)
+            except BudgetExceeded as e:
+                warn("Slide %d: %s, rendering a placeholder" % (slide.nr, e))
+                slide.stats["budget_exceeded"] = str(e)
+                render_placeholder(device, width, height)
+                return
+            finally:
+                Budget.current = None
+            replay(device, recording)
+        return render_within_budget
+
+def render_placeholder(device, width, height):
+    """ Draw a crossed-out gray page, for slides that couldn't be rendered """
+    device.set_source_rgba(0.9, 0.9, 0.9, 1)
+    device.rectangle(0, 0, width, height)
+    device.fill()
+    device.set_source_rgba(0.6, 0.6, 0.6, 1)
+    device.set_line_width(2)
+    device.move_to(0, 0)
+    device.line_to(width, height)
+    device.move_to(width, 0)
+    device.line_to(0, height)
+    device.stroke()
+
+def _render_part(filename, settings, numbers, outputs):
+    """ Process pool worker: renders the slides with the given numbers
+        into the given outputs.
+        If the pool forked from the process that loaded the document, the
+        already parsed Keynote is reused (and only the archive is reopened,
+        once per process, since the file handle would otherwise be shared
+        with the parent). Otherwise, only the slides of this part are
+        parsed. """
+    doc = getattr(Keynote, "current", None)
+    if doc is not None and doc.filename == filename and \
+       numbers <= set(slide.nr for slide in doc.slides):
+        if doc.pid != os.getpid():
+            doc.z = zipfile.ZipFile(filename)
+            doc.pid = os.getpid()
+    else:
+        Options.settings.update(settings)
+        Options.settings["pages"] = ",".join(str(nr) for nr in numbers)
+        doc = Keynote(filename)
+    slides = [slide for slide in doc.slides if slide.nr in numbers]
+    doc.render(slides, outputs)
+
 class Keynote(object):
-    def __init__(self, filename):
+    def __init__(self, filename, mode=RENDER):
         Keynote.current = self
+        self.filename = filename
+        self.mode = mode
         self.z = zipfile.ZipFile(filename)
+        # the process the archive was opened in, see _render_part()
+        self.pid = os.getpid()
         self.filenames = set(self.z.namelist())
         self.used_filenames = set()
 
-        with self.open("index.apxl") as f:
-            self.index = Index(self, f)
+        if mode != TEXT:
+            load_rendering_modules()
+        if mode == RENDER:
+            if options.layout_cache:
+                LayoutCache.current = LayoutCache(options.layout_cache)
+            else:
+                LayoutCache.current = None
+            if options.font_dir:
+                use_bundled_fonts(options.font_dir)
+            self.load_embedded_fonts()
+
+        self.index = Index(self)
 
         self.slides = self.index.slides()
 
+    def load_embedded_fonts(self):
+        """ Make fonts stored in the archive available to this document.
+            They're loaded straight from memory, and replace the embedded
+            fonts of the previous document. """
+        release_embedded_fonts()
+        for path in sorted(self.filenames):
+            if os.path.splitext(path)[1].lower() in FONT_EXTENSIONS:
+                family = add_embedded_font(self.read_file(path), path)
+                if family is not None:
+                    info("Embedded font %s: %s" % (path, family))
+
+    def close(self):
+        """ Release the archive and the embedded fonts """
+        release_embedded_fonts()
+        self.z.close()
+
     @staticmethod
     def read_file(path):
         Keynote.current.used_filenames.add(path)
@@ -76,14 +252,244 @@ class Keynote(object):
     def __contains__(self, path):
         return None if (path not in self.filenames) else True
 
-    def save(self, output_file):
-        surface = cairo.PDFSurface(output_file, self.index.width, self.index.height)
-        context = cairo.Context(surface)
-        info("Rendering...")
+    def selected_slides(self):
+        return [slide for slide in self.slides
+                if utils.is_in_range(slide.nr, options.pages)]
+
+    def render(self, slides, outputs):
+        """ Render slides into a list of outputs (see output.py).
+            If there is more than one output (or the output asks for it),
+            every slide is only rendered once, into a recording, which is
+            then replayed into each of the outputs.
+            Slides that are too complex for vector outputs (see
+            Slide.should_flatten()) are rasterized from that recording, and
+            the image is drawn into the vector outputs only. Raster outputs
+            still get the recording, at their own resolution. """
+        width, height = self.index.width, self.index.height
+        for output in outputs:
+            output.begin(width, height)
+        vector = any(output.vector for output in outputs)
+        for slide in slides:
+            render = slide.render
+            if Budget.enabled():
+                render = Budget.guard(slide, render)
+            flatten = vector and slide.should_flatten()
+            if len(outputs) == 1 and not outputs[0].needs_recording() and not flatten:
+                render(outputs[0].begin_page(slide.nr))
+            else:
+                recording = record(render, width, height)
+                flattened = None
+                if flatten:
+                    flattened = record(lambda device: slide.render_flattened(device, recording),
+                                       width, height)
+                for output in outputs:
+                    if flattened is not None and output.vector:
+                        output.replay_page(slide.nr, flattened)
+                    else:
+                        output.replay_page(slide.nr, recording)
+            for output in outputs:
+                output.end_page(slide.nr)
+        for output in outputs:
+            output.finish()
+        if LayoutCache.current is not None:
+            info("Layout cache: %d hits, %d misses" % (LayoutCache.current.hits,
+                                                      LayoutCache.current.misses))
+
+    def thumbnails(self, size=None):
+        """ Iterator. Yields (slide number, PIL image) for the thumbnail
+            images Keynote stores with the selected slides. If size (width,
+            height) is given, images are scaled down to fit into it. """
+        for thumbnail in self.selected_thumbnails():
+            image = thumbnail.image(size)
+            if image is not None:
+                yield thumbnail.nr, image
+
+    def selected_thumbnails(self):
+        """ Returns the Thumbnails of the selected slides (nothing is
+            decoded yet) """
+        return [thumbnail for thumbnail in self.index.thumbnails()
+                if utils.is_in_range(thumbnail.nr, options.pages)]
+
+    def extract_text(self):
+        """ Iterator. Yields a dict {"slide": number, "text": [...]} for
+            every selected slide, with the text of each of its text boxes,
+            in document order. Line breaks and the ends of paragraphs are
+            returned as newlines.
+            To skip everything that's only needed for rendering, load the
+            document with mode=TEXT. """
+        for slide in self.selected_slides():
+            yield {"slide": slide.nr, "text": slide.text()}
+
+    def save_thumbnails(self, filename, size=None):
+        """ Save the thumbnails of the selected slides into image files.
+            The filename is a pattern like "slide-%d.png", which gets the
+            slide number filled in (unless there's only one thumbnail).
+            Raises ValueError for filenames that aren't such a pattern. """
+        utils.check_pattern(filename, len(self.selected_thumbnails()))
+        if os.path.dirname(filename):
+            utils.mkdir_p(os.path.dirname(filename))
+        for nr,image in self.thumbnails(size):
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA")
+            image.save(filename % nr if "%" in filename else filename)
+
+    def get_slide(self, nr):
         for slide in self.slides:
-            if utils.is_in_range(slide.nr, options.pages):
-                slide.render(context)
-        surface.finish()
+            if slide.nr == nr:
+                return slide
+        raise KeyError("no slide %d" % nr)
+
+    def image_size(self, scale=1.0):
+        """ The size (in pixels) of a slide rendered with the given scale """
+        return (int(math.ceil(self.index.width * scale)),
+                int(math.ceil(self.index.height * scale)))
+
+    def render_slide_array(self, nr, scale=1.0):
+        """ Render a slide into a new image surface, and return its pixels as
+            a (height, width, 4) uint8 numpy array.
+            The array is a view on the surface's memory (nothing is copied),
+            in cairo's ARGB32 layout: premultiplied alpha, with the channels
+            in B,G,R,A order on little-endian machines. """
+        width, height = self.image_size(scale)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self._render_into(surface, self.get_slide(nr), scale)
+        return surface_array(surface)
+
+    def iter_slide_arrays(self, numbers=None, scale=1.0):
+        """ Iterator. Renders slides (by default, the selected ones) one at
+            a time and yields (slide number, pixels), like
+            render_slide_array().
+            All slides are rendered into the same buffer, so every array is
+            overwritten by the next slide. Copy it if you need to keep it. """
+        if numbers is None:
+            slides = self.selected_slides()
+        else:
+            slides = [self.get_slide(nr) for nr in numbers]
+        width, height = self.image_size(scale)
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        buffer = numpy.zeros((height, stride), dtype=numpy.uint8)
+        surface = cairo.ImageSurface.create_for_data(buffer, cairo.FORMAT_ARGB32,
+                                                     width, height, stride)
+        pixels = surface_array(surface)
+        for slide in slides:
+            context = cairo.Context(surface)
+            context.set_operator(cairo.OPERATOR_CLEAR)
+            context.paint()
+            self._render_into(surface, slide, scale)
+            yield slide.nr, pixels
+
+    def render_tile(self, nr, z, x, y, tile_size=256):
+        """ Render the tile at column x, row y of zoom level z of a slide,
+            and return it as an image surface. At zoom level z, the slide is
+            2**z tiles wide.
+            Only the drawables that intersect the tile are rendered. """
+        scale = tile_size * 2**z / float(self.index.width)
+        size = tile_size / scale
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, tile_size, tile_size)
+        device = Device(cairo.Context(surface))
+        device.scale(scale, scale)
+        device.translate(-x * size, -y * size)
+        self.get_slide(nr).render_area(device, x * size, y * size,
+                                       (x + 1) * size, (y + 1) * size)
+        surface.flush()
+        return surface
+
+    def _render_into(self, surface, slide, scale):
+        device = Device(cairo.Context(surface))
+        device.scale(scale, scale)
+        slide.render(device)
+        surface.flush()
+
+    def render_pdf(self, slides, output_file):
+        self.render(slides, [PDFOutput(output_file)])
+
+    def iter_pages(self):
+        """ Iterator. Renders the selected slides one at a time, and yields
+            (slide number, PDF data) for every slide as soon as it is
+            rendered. Each page is a complete single-page PDF document. """
+        for slide in self.selected_slides():
+            fi = BytesIO()
+            self.render_pdf([slide], fi)
+            yield slide.nr, fi.getvalue()
+
+    def save(self, output_file, jobs=1):
+        self.save_as([PDFOutput(output_file)], jobs)
+
+    def save_as(self, outputs, jobs=1):
+        """ Render the selected slides into all of the given outputs.
+            Raises ValueError if an output that writes one file per slide
+            doesn't have a filename pattern like "slide-%d.png". """
+        slides = self.selected_slides()
+        for output in outputs:
+            output.check_filename(len(slides))
+        if jobs <= 1 or len(slides) <= 1:
+            info("Rendering...")
+            self.render(slides, outputs)
+        else:
+            self.save_parallel(slides, outputs, jobs)
+
+    def save_parallel(self, slides, outputs, jobs):
+        """ Render consecutive ranges of slides in a process pool, each into
+            its own set of partial outputs, and then join the parts.
+            Worker processes forked from this one reuse the parsed document,
+            and keep their caches (master slides, fonts, text layouts) from
+            one range to the next. If none of the outputs needs joining
+            (e.g. one image per slide), the slides are split into more,
+            smaller ranges. """
+        if any(output.joined for output in outputs):
+            count = jobs
+        else:
+            # nothing to join: hand out smaller parts, so that processes
+            # that finish early can pick up more slides
+            count = jobs * 4
+        parts = utils.split([slide.nr for slide in slides], count)
+        processes = min(jobs, len(parts))
+        info("Rendering %d slides in %d processes..." % (len(slides), processes))
+        settings = get_settings()
+        with utils.tempdir("keynote") as dir:
+            part_outputs = [[output.part(os.path.join(dir, "part%d-%d" % (i, j)))
+                             for j,output in enumerate(outputs)]
+                            for i in range(len(parts))]
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = [pool.apply_async(_render_part,
+                               (self.filename, settings, set(numbers),
+                                part_outputs[i]))
+                           for i,numbers in enumerate(parts)]
+                for result in results:
+                    result.get()
+            finally:
+                pool.close()
+                pool.join()
+            info("Joining %d parts..." % len(part_outputs))
+            for j,output in enumerate(outputs):
+                output.join([part[j] for part in part_outputs])
+
+def surface_array(surface):
+    """ Returns a (height, width, 4) numpy array that shares its memory with
+        an ARGB32 image surface """
+    return numpy.ndarray(shape=(surface.get_height(), surface.get_width(), 4),
+                         dtype=numpy.uint8, buffer=surface.get_data(),
+                         strides=(surface.get_stride(), 4, 1))
+
+def record(render, width, height):
+    """ Run a render function on a cairo recording surface of the given size,
+        and return the surface. The recorded drawing operations can then be
+        replayed (any number of times, and into any other surface) with
+        replay(). """
+    surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, (0, 0, width, height))
+    render(Device(cairo.Context(surface)))
+    return surface
+
+def replay(device, recording):
+    """ Replay a recording surface created by record().
+        PDF surfaces emit a recording surface as a form XObject the first
+        time it is used, and reference that XObject on every later use. """
+    device.set_source_surface(recording, 0, 0)
+    device.paint()
+
+def flatten_dpi():
+    return options.flatten_dpi or DEFAULT_FLATTEN_DPI
 
 class StrokeStyle(object):
     def __init__(self, color, width, cap_style, join_style, miter_limit):
@@ -93,22 +499,28 @@ class StrokeStyle(object):
         self.join_style = join_style
         self.miter_limit = miter_limit
 
+    def key(self):
+        return (self.color, self.width, self.cap_style, self.join_style,
+                self.miter_limit)
+
+    # names of the cairo constants, since cairo is only imported for
+    # rendering
     join_map = {
-        "miter": cairo.LINE_JOIN_MITER,
-        "bevel": cairo.LINE_JOIN_BEVEL,
-        "round": cairo.LINE_JOIN_ROUND,
+        "miter": "LINE_JOIN_MITER",
+        "bevel": "LINE_JOIN_BEVEL",
+        "round": "LINE_JOIN_ROUND",
     }
     cap_map = {
-        "butt": cairo.LINE_CAP_BUTT,
-        "round": cairo.LINE_CAP_ROUND,
-        "square": cairo.LINE_CAP_SQUARE,
+        "butt": "LINE_CAP_BUTT",
+        "round": "LINE_CAP_ROUND",
+        "square": "LINE_CAP_SQUARE",
     }
     def apply(self, device):
         r,g,b,a = self.color
         device.set_source_rgba(r,g,b,a)
         device.set_line_width(self.width)
-        device.set_line_join(self.join_map[self.join_style])
-        device.set_line_cap(self.cap_map[self.cap_style])
+        device.set_line_join(getattr(cairo, self.join_map[self.join_style]))
+        device.set_line_cap(getattr(cairo, self.cap_map[self.cap_style]))
         if self.miter_limit is not None:
             device.set_miter_limit(self.miter_limit)
 
@@ -207,6 +619,8 @@ class Primitives(object):
 
 class Bitmap(object):
     filename_to_surface = {}
+    # (width, height, opaque) of image files, see header()
+    filename_to_header = {}
     """
         <x>
           <sf:unfiltered sfa:ID="SFRImageBinary-0">
@@ -218,8 +632,10 @@ class Bitmap(object):
           </sf:extent>
         </x>
     """
-    def __init__(self, path):
+    def __init__(self, path, width=None, height=None):
         self.path = path
+        self.width = width
+        self.height = height
 
     @staticmethod
     def read(e):
@@ -227,25 +643,62 @@ class Bitmap(object):
         unfiltered = e.find_or_lookup(ns("sf:unfiltered"))
         data = unfiltered.find_or_lookup(ns("sf:data"))
         path = data.get(ns("sf:path"))
+        size = unfiltered.find(ns("sf:size"))
+        if size is not None:
+            return Bitmap(path, float(size.get(ns("sfa:w"))), float(size.get(ns("sfa:h"))))
         return Bitmap(path)
 
+    def pixels(self):
+        """ The number of pixels of this image, as stored in the document """
+        if self.width is None or self.height is None:
+            return 0
+        return self.width * self.height
+
     def surface_from_data(self, data):
+        """ Decode an image into a new cairo image surface.
+            PIL decodes the image into its own buffer (it can't decode into
+            someone else's), and then packs the pixels into cairo's format
+            (BGRA with premultiplied alpha, or BGRX for opaque images) in a
+            single pass, a few rows at a time, straight into the surface's
+            buffer. """
         im = Image.open(BytesIO(data))
-        im.putalpha(256) # create alpha channel
+        # only the header has been read so far
+        Budget.allocate_current(im.size[0] * im.size[1] * 4, self.path)
+        width, height = im.size
+        if not Bitmap.is_opaque(im):
+            if im.mode != "RGBA":
+                im = im.convert("RGBA")
+            format, rawmode = cairo.FORMAT_ARGB32, "BGRa"
+        else:
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            format, rawmode = cairo.FORMAT_RGB24, "BGRX"
 
         try:
-            arr = numpy.array(im)
-            height, width, channels = arr.shape
-            r = arr[:,:,0]
-            g = arr[:,:,1]
-            b = arr[:,:,2]
-            a = arr[:,:,3]
-            arr = numpy.zeros(arr.shape, dtype=arr.dtype)
-            arr[:,:,0] = b
-            arr[:,:,1] = g
-            arr[:,:,2] = r
-            arr[:,:,3] = a
-            surface = cairo.ImageSurface.create_for_data(arr, cairo.FORMAT_ARGB32, width, height)
+            surface = cairo.ImageSurface(format, width, height)
+            stride = surface.get_stride()
+            buffer = surface.get_data()
+            # what im.tobytes() does, without joining the rows into
+            # another full-size copy
+            im.load()
+            encoder = Image._getencoder(im.mode, "raw", (rawmode, stride, 1))
+            encoder.setimage(im.im, (0, 0) + im.size)
+            offset = 0
+            while True:
+                # the raw encoder only returns whole rows
+                consumed, error, rows = encoder.encode(max(65536, stride))
+                if sys.byteorder == "big":
+                    # cairo's pixels are native-endian 32 bit words, so on big
+                    # endian machines the byte order is A,R,G,B instead
+                    words = numpy.frombuffer(rows, dtype=numpy.uint8).reshape(-1, 4)
+                    rows = words[:, ::-1].tobytes()
+                buffer[offset:offset + len(rows)] = rows
+                offset += len(rows)
+                if error:
+                    break
+            if error < 0:
+                raise IOError("encoder error %d for %s" % (error, self.path))
+            surface.mark_dirty()
         except NotImplementedError: # happens for pycairo 1.10.0
             with utils.tempfile(".png") as filename:
                 im.save(filename)
@@ -281,7 +734,57 @@ class Bitmap(object):
                 if data is None:
                     return None
             Bitmap.filename_to_surface[self.path] = self.surface_from_data(data)
-        return Bitmap.filename_to_surface[self.path]
+        surface = Bitmap.filename_to_surface[self.path]
+        Budget.allocate_current(surface.get_stride() * surface.get_height(), self.path)
+        return surface
+
+    @staticmethod
+    def is_opaque(im):
+        """ Whether a PIL image can't have transparent pixels """
+        return not ("A" in im.mode or "a" in im.mode or "transparency" in im.info)
+
+    def header(self):
+        """ Returns (width, height, opaque) of the image, or None if it can't
+            be read. Only the header of the file is parsed, so this is
+            cheap enough for deciding what needs to be drawn; the pixels
+            are only decoded by get_surface(). """
+        if self.path not in Bitmap.filename_to_header:
+            Bitmap.filename_to_header[self.path] = self._read_header()
+        return Bitmap.filename_to_header[self.path]
+
+    def _read_header(self):
+        if self.path.endswith(".pdf"):
+            # these are only converted into images by get_surface()
+            surface = self.get_surface()
+            if surface is None:
+                return None
+            return (surface.get_width(), surface.get_height(),
+                    surface.get_format() == cairo.FORMAT_RGB24)
+        data = Keynote.read_file(self.path)
+        if data is None:
+            return None
+        try:
+            im = Image.open(BytesIO(data))
+        except IOError:
+            warn("Couldn't read image %s" % self.path)
+            return None
+        return im.size[0], im.size[1], Bitmap.is_opaque(im)
+
+    def charge(self):
+        """ Charge the current budget for this image, like get_surface()
+            does, for when it is drawn from a recording """
+        header = self.header()
+        if header is not None:
+            Budget.allocate_current(header[0] * header[1] * 4, self.path)
+
+    def covers(self, x, y, width, height):
+        """ Returns True if this bitmap, drawn at (x,y), covers the rectangle
+            (0,0)-(width,height) with opaque pixels """
+        header = self.header()
+        if header is None:
+            return False
+        w, h, opaque = header
+        return opaque and x <= 0 and y <= 0 and x + w >= width and y + h >= height
 
 
 class TexturedFill(object):
@@ -311,6 +814,15 @@ class TexturedFill(object):
         path = Bitmap.read(image)
         return TexturedFill(path)
 
+    def is_visible(self):
+        return True
+
+    def covers(self, width, height):
+        return self.path.covers(0, 0, width, height)
+
+    def images(self):
+        return [self.path]
+
     def render(self, device, width, height):
         surface = self.path.get_surface()
         if surface is None:
@@ -327,6 +839,15 @@ class PlainFill(object):
     def __init__(self, color):
         self.color = color
 
+    def is_visible(self):
+        return self.color[3] > 0
+
+    def covers(self, width, height):
+        return self.color[3] >= 1.0
+
+    def images(self):
+        return []
+
     def render(self, device, width, height):
         r,g,b,a = self.color 
         device.set_source_rgba(r,g,b,a)
@@ -346,16 +867,63 @@ class Index(object):
     styles = {}
     stylesheets = {}
     master_slides = {}
+    # number of occurrences / recordings of drawables, by content key
+    drawable_count = {}
+    drawable_recordings = {}
 
-    def __init__(self, doc, fi):
+    def __init__(self, doc):
         Index.current = self
         self.doc = doc
-        self.xml = XML(fi.read())
+        Index.styles = {}
+        # text styles hold fonts, which may be embedded in the document
+        TextStyle.interned = {}
+        Index.stylesheets = {}
+        Index.master_slides = {}
+        Index.drawable_count = {}
+        Index.drawable_recordings = {}
+        Element.registry = {}
+        # Stylesheets and master slides are only parsed once a slide
+        # references them, see get_stylesheet() and get_master_slide()
+        self.load()
         assert self.xml.tag == ns("key:presentation")
-        assert len(Index.styles) == 0
         self.parse_size()
-        self.parse_stylesheets()
-        self.parse_master_slides()
+
+    def load(self):
+        """ Stream index.apxl, and parse each slide in the requested page
+            range as soon as it has been read. Slides are discarded right
+            after parsing, and we stop reading after the last requested one.
+            In THUMBNAILS mode, only the thumbnail paths of the slides are
+            read.
+
+            To know which elements need to be kept around for resolving
+            references, we do a first pass over the file that only collects
+            the referenced IDs. (This assumes that slides don't reference
+            elements of later slides.)
+        """
+        last = utils.parse_range(options.pages).last()
+        if self.doc.mode == THUMBNAILS:
+            # nothing gets parsed that could hold references
+            ids = set()
+        else:
+            with self.doc.open("index.apxl") as fi:
+                ids = collect_references(fi, ["sfa:IDREF", "sf:style"],
+                                         "key:slide", last)
+        self._slides = []
+        self._thumbnails = []
+        with self.doc.open("index.apxl") as fi:
+            stream = XMLStream(fi, "key:slide", ids)
+            nr = 0
+            for element in stream:
+                nr += 1
+                if utils.is_in_range(nr, options.pages):
+                    thumbnail = Thumbnail.read(element, nr)
+                    if thumbnail is not None:
+                        self._thumbnails.append(thumbnail)
+                    if self.doc.mode != THUMBNAILS:
+                        self._slides.append(Slide(element, nr))
+                if nr >= last:
+                    break
+            self.xml = stream.root
 
     @staticmethod
     def add_style_to_registry(id, obj):
@@ -368,18 +936,45 @@ class Index(object):
         self.width = int(size.get(ns("sfa:w")))
         self.height = int(size.get(ns("sfa:h")))
 
-    def parse_stylesheets(self):
-        for element in self.xml.iter(ns("key:stylesheet")):
-            id = element.get(ns("sfa:ID"))
-            Index.stylesheets[id] = Stylesheet(element)
+    @staticmethod
+    def get_stylesheet(id, element=None):
+        """ Returns the stylesheet with the given ID, parsing it the first
+            time it's requested. """
+        # stylesheets without an ID can't be referenced, so cache them
+        # by their element
+        key = id if id is not None else element.e
+        if key not in Index.stylesheets:
+            if element is None:
+                element = Element(Element.registry[id])
+            Index.stylesheets[key] = Stylesheet(element)
+        return Index.stylesheets[key]
+
+    @staticmethod
+    def get_master_slide(id):
+        """ Returns the master slide with the given ID, parsing it the first
+            time it's requested. """
+        if id not in Index.master_slides:
+            Index.master_slides[id] = Slide(Element(Element.registry[id]), None)
+        return Index.master_slides[id]
 
-    def parse_master_slides(self):
-        for element in self.xml.iter(ns("key:master-slide")):
-            id = element.get(ns("sfa:ID"))
-            Index.master_slides[id] = Slide(element, None)
+    @staticmethod
+    def find_style(id):
+        """ Returns the style with the given ID, or None.
+            Styles get registered when their stylesheet is parsed, so for a
+            style we don't know yet, parse the stylesheet it's defined in. """
+        if id not in Index.styles and id in Element.registry:
+            e = Element.registry[id].getparent()
+            while e is not None and e.tag != ns("key:stylesheet"):
+                e = e.getparent()
+            if e is not None:
+                Index.get_stylesheet(e.get(ns("sfa:ID")), Element(e))
+        return Index.styles.get(id)
 
     def slides(self):
-        return [Slide(child, i+1) for i,child in enumerate(self.xml.find(ns("key:slide-list"))) if utils.is_in_range(i+1,options.pages)]
+        return self._slides
+
+    def thumbnails(self):
+        return self._thumbnails
 
 class Style(dict):
     def __init__(self, styles, id=None, ident=None, parent_ident=None):
@@ -492,7 +1087,7 @@ class Stylesheet(object):
         parent_ref = self.xml.find(ns("sf:parent-ref"))
         if parent_ref is not None:
             idref = parent_ref.get(ns("sfa:IDREF"))
-            self.parent = Index.stylesheets[idref]
+            self.parent = Index.get_stylesheet(idref)
         else:
             self.parent = None
 
@@ -507,14 +1102,14 @@ class Stylesheet(object):
         stylesheet_ref = xml.find(ns("sf:stylesheet-ref"))
         if stylesheet_ref is not None:
             id_ref = stylesheet_ref.get(ns("sfa:IDREF"))
-            return Index.stylesheets[id_ref]
+            return Index.get_stylesheet(id_ref)
 
         stylesheet= xml.find(ns("key:stylesheet"))
         if stylesheet is not None:
-            # We already parsed this style sheet, so instead of
-            # parsing it again, just look it up by its ID
+            # If we already parsed this style sheet, don't parse it again,
+            # but look it up by its ID
             id = stylesheet.get(ns("sfa:ID"))
-            return Index.stylesheets[id]
+            return Index.get_stylesheet(id, stylesheet)
 
         return None
 
@@ -593,8 +1188,12 @@ class Path(object):
        </sf:path>
     """
 
+    # number of coordinates of every path command
+    ARGUMENTS = {"M": 2, "L": 2, "C": 6, "Z": 0}
+
     def __init__(self):
         self.beziers = []
+        self._segments = None
 
     @staticmethod
     def read(xml):
@@ -644,36 +1243,50 @@ class Path(object):
             warn("Unknown point path type: %s" % type)
             return None
 
+    def segments(self):
+        """ Returns the parsed path, as a list of (command, coordinates)
+            tuples. Paths are only parsed once. """
+        if self._segments is None:
+            self._segments = []
+            for bezier in self.beziers:
+                items = bezier.split(" ")
+                i = 0
+                while i<len(items):
+                    cmd = items[i]
+                    if cmd in Path.ARGUMENTS:
+                        n = Path.ARGUMENTS[cmd]
+                        coords = tuple(float(item) for item in items[i+1:i+1+n])
+                        self._segments.append((cmd, coords))
+                        i += n + 1
+                    else:
+                        i += 1
+        return self._segments
+
+    def bounds(self):
+        """ Returns the bounding box (x1,y1,x2,y2) of all points of this path,
+            including control points, or None if the path is empty """
+        xs = []
+        ys = []
+        for cmd,coords in self.segments():
+            xs += coords[0::2]
+            ys += coords[1::2]
+        if not xs:
+            return None
+        return min(xs), min(ys), max(xs), max(ys)
+
     def apply(self, device, x0, y0):
-        for bezier in self.beziers:
-            i = 0
-            items = bezier.split(" ")
-            while i<len(items):
-                cmd = items[i]
-                if cmd == "M":
-                    x = float(items[i+1])
-                    y = float(items[i+2])
-                    i += 3
-                    device.move_to(x0 + x, y0 + y)
-                elif cmd == "L":
-                    x = float(items[i+1])
-                    y = float(items[i+2])
-                    i += 3
-                    device.line_to(x0 + x, y0 + y)
-                elif cmd == "C":
-                    x1 = float(items[i+1])
-                    y1 = float(items[i+2])
-                    x2 = float(items[i+3])
-                    y2 = float(items[i+4])
-                    x3 = float(items[i+5])
-                    y3 = float(items[i+6])
-                    i += 7
-                    device.curve_to(x0 + x1, y0 + y1,
-                                     x0 + x2, y0 + y2,
-                                     x0 + x3, y0 + y3)
-                elif cmd == "Z":
-                    i += 1
-                    pass
+        for cmd,coords in self.segments():
+            if cmd == "M":
+                x,y = coords
+                device.move_to(x0 + x, y0 + y)
+            elif cmd == "L":
+                x,y = coords
+                device.line_to(x0 + x, y0 + y)
+            elif cmd == "C":
+                x1,y1,x2,y2,x3,y3 = coords
+                device.curve_to(x0 + x1, y0 + y1,
+                                 x0 + x2, y0 + y2,
+                                 x0 + x3, y0 + y3)
 
 class StyleState(dict):
     """ A style object or reference.
@@ -696,8 +1309,9 @@ class StyleState(dict):
         """ Lookup a style by identifier.
             Used e.g. for <sf:p sf:style>.
         """
-        if id in Index.styles:
-            self.update(Index.styles[id])
+        style = Index.find_style(id)
+        if style is not None:
+            self.update(style)
         else:
             # E.g. 98219213 uses sf:style to reference a ident
             self.update(stylesheet.ident_lookup[id])
@@ -732,6 +1346,59 @@ class StyleState(dict):
         return s
 
 
+class TextStyle(object):
+    """ The attributes of a text run that are used for rendering it, with
+        defaults filled in. Text styles are interned, so runs with the same
+        attributes share one TextStyle.
+        When rendering, the font is looked up (and measured) when the style
+        is created, so that rendering doesn't need to. """
+    interned = {}
+    # used for attributes that neither the text nor any of the stylesheets
+    # it inherits from set
+    DEFAULT_FONT_NAME = "Comic Sans MS"
+    DEFAULT_FONT_SIZE = 12
+    DEFAULT_COLOR = (0, 0, 0, 0)
+    DEFAULT_ALIGNMENT = 0
+
+    def __init__(self, font_name, font_size, color, alignment):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.color = color
+        self.alignment = alignment
+        self.key = (font_name, font_size, color, alignment)
+        self.face = None
+        self.font_file = None
+        self.cached_font = None
+        self.font_extents = None
+
+    def resolve_font(self):
+        self.font_file = find_font_file(self.font_name)
+        self.face = find_cairo_font(self.font_name)
+        self.cached_font = CachedScaledFont(self.face, self.font_size)
+        self.font_extents = font_extents(self.face, self.font_size)
+
+    @staticmethod
+    def get(style):
+        """ Returns the (interned) text style for a StyleState """
+        font_name = style.get("fontName")
+        if font_name is None:
+            font_name = TextStyle.DEFAULT_FONT_NAME
+        font_size = style.get("fontSize")
+        if font_size is None:
+            font_size = TextStyle.DEFAULT_FONT_SIZE
+        color = style.get("fontColor")
+        if color is None:
+            color = TextStyle.DEFAULT_COLOR
+        key = (font_name, font_size, tuple(color),
+               style.get("alignment", TextStyle.DEFAULT_ALIGNMENT))
+        text_style = TextStyle.interned.get(key)
+        if text_style is None:
+            text_style = TextStyle(*key)
+            TextStyle.interned[key] = text_style
+        if text_style.face is None and Keynote.current.mode == RENDER:
+            text_style.resolve_font()
+        return text_style
+
 class Text(object):
     """ A text object.
 
@@ -750,16 +1417,30 @@ class Text(object):
 
     def __init__(self):
         self.content = []
+        # indices into content where paragraphs start
+        self.paragraphs = set()
 
 
     def text(self, text, styles):
-        self.content.append(("text", text, styles))
+        self.content.append(("text", text, TextStyle.get(styles)))
+
+    def plain_text(self):
+        """ Returns the text, without styles, with line breaks as newlines.
+            Paragraphs that don't end in a line break are also separated
+            by a newline. """
+        parts = []
+        for i,(type,text,style) in enumerate(self.content):
+            if i in self.paragraphs and i > 0 and self.content[i - 1][0] != "br":
+                parts.append("\n")
+            parts.append(text if type == "text" else "\n")
+        return "".join(parts)
 
     def br(self, styles):
-        self.content.append(("br", None, styles))
+        self.content.append(("br", None, TextStyle.get(styles)))
 
     def recurse(self, e, styles, stylesheet):
         if e.tag == ns("sf:p"):
+            self.paragraphs.add(len(self.content))
             styles = styles.add_from_reference(e.get(ns("sf:style")), stylesheet)
             list_level = e.get(ns("sf:list-level"))
             if list_level is not None:
@@ -768,7 +1449,8 @@ class Text(object):
                 self.text(e.text, styles)
             for child in e:
                 self.recurse(child, styles, stylesheet)
-            if e.tail is not None:
+            # (whitespace between paragraphs is only indentation)
+            if e.tail is not None and e.tail.strip():
                 self.text(e.tail, styles)
         elif e.tag == ns("sf:span") or e.tag == ns("sf:layout"):
             assert e.get(ns("sfa:style")) is None # can this happen?
@@ -813,7 +1495,7 @@ class Text(object):
                 style = graphics_style
                 style.update(text_style)
 
-                assert textbody.text is None
+                assert textbody.text is None or not textbody.text.strip()
                 for child in textbody:
                     text.recurse(child, style, stylesheet)
         return text
@@ -831,8 +1513,30 @@ class Drawable(object):
         self.style = style
         self.path = path
         self.text = text
+        self._layout = None
        
-    def render_text(self, device):
+    def layout(self):
+        """ Returns the LayoutResult of this drawable's text.
+            Layouts are looked up in the layout cache (if there is one) by
+            the text, the styles, the font files the styles resolve to, and
+            the width of the text box. """
+        if self._layout is not None:
+            return self._layout
+        cache = LayoutCache.current
+        if cache is not None:
+            key = (tuple((type, text, style.key, style.font_file)
+                         for type,text,style in self.text.content),
+                   self.geometry.width)
+            self._layout = cache.get(key)
+            if self._layout is None:
+                self._layout = self.compute_layout()
+                cache.put(key, self._layout)
+        else:
+            self._layout = self.compute_layout()
+        return self._layout
+
+    def compute_layout(self):
+        result = LayoutResult()
         x = 0
         y = 0
 
@@ -840,25 +1544,8 @@ class Drawable(object):
         has_line = True 
 
         for type,text,style in self.text.content:
-
-            # TODO: what are the defaults for these?
-            device.set_font_face(find_cairo_font("Comic Sans MS"))
-            device.set_font_size(12)
-            device.set_source_rgba(0,0,0,0)
-
-            if style.get("fontName") is not None:
-                ttf = find_cairo_font(style["fontName"])
-                device.set_font_face(ttf)
-            if style.get("fontSize") is not None:
-                device.set_font_size(style["fontSize"])
-            if style.get("fontColor") is not None:
-                r,g,b,a = style["fontColor"]
-                device.set_source_rgba(r,g,b,a)
-
-            alignment = style.get("alignment", 0)
-
             (ascent, descent, height, 
-             max_x_advance, max_y_advance) = device.font_extents()
+             max_x_advance, max_y_advance) = style.font_extents
 
             if type == "br":
                 if has_line:
@@ -866,53 +1553,37 @@ class Drawable(object):
                     y += ascent + descent
                     has_line = False
             elif type == "text":
-                words = text.split(" ")
-                (space_x_bearing, space_y_bearing, space_width, 
-                 space_height, space_x_advance, space_y_advance) = device.text_extents(" ")
-
-                line = []
-                lines = [line]
-
-                # FIXME: we don't always start with x = 0 if the style switching within a line
-                x = 0
-                for word in words:
-                    if not len(word):
-                        continue
-                    (x_bearing, y_bearing, width, 
-                     height, x_advance, y_advance) = device.text_extents(word)
-                    w = width - x_bearing - TEXTBOX_X_OVERFLOW_LEEWAY
-
-                    if x > 0 and x + w > self.geometry.width:
-                        x = 0
-                        line = [word]
-                        lines.append(line)
-                    else:
-                        x += x_advance + space_x_advance
-                        line.append(word)
-                
-                first = True
+                run = result.add_run(style.font_name, style.font_size, style.color)
+                lines = layout_text(style.cached_font, text,
+                                    self.geometry.width + TEXTBOX_X_OVERFLOW_LEEWAY)
                 for line in lines:
                     if has_line:
                         y += ascent + descent
                         has_line = False
-                    first = False
-
-                    text = " ".join(line)
-                    (x_bearing, y_bearing, width, 
-                     height, x_advance, y_advance) = device.text_extents(text)
 
-                    if alignment == ALIGN_LEFT or alignment is None:
+                    if style.alignment == ALIGN_LEFT or style.alignment is None:
                         x = 0
-                    elif alignment == ALIGN_RIGHT:
-                        x = self.geometry.width - width
-                    elif alignment == ALIGN_CENTER:
-                        x = (self.geometry.width - width) / 2
-
-                    device.move_to(self.geometry.x + x, 
-                                   self.geometry.y + y)
-                    x += x_advance
-                    device.show_text(text)
+                    elif style.alignment == ALIGN_RIGHT:
+                        x = self.geometry.width - line.width
+                    elif style.alignment == ALIGN_CENTER:
+                        x = (self.geometry.width - line.width) / 2
+
+                    run.lines.append((x, y, line))
+                    x += line.width
                     has_line = True
+        return result
+
+    def render_text(self, device):
+        if self.text is None:
+            return
+        # layout runs are the text runs (without line breaks), in order
+        styles = [style for type,text,style in self.text.content if type == "text"]
+        for run,style in zip(self.layout().runs, styles):
+            device.set_font_face(style.face)
+            device.set_font_size(style.font_size)
+            device.set_source_rgba(*style.color)
+            for x,y,line in run.lines:
+                line.draw(device, self.geometry.x + x, self.geometry.y + y)
 
     def render_path(self, device):
         if self.path is None:
@@ -931,7 +1602,73 @@ class Drawable(object):
             device.stroke()
 
     def has_text(self):
-        return len(self.text.content)
+        return self.text is not None and len(self.text.content)
+
+    def images(self):
+        return []
+
+    def is_visible(self, width, height):
+        """ Returns False if rendering this drawable wouldn't change any
+            pixel on a page of the given size """
+        g = self.geometry
+        if self.has_text():
+            # text is drawn below, but may extend to the left or right of
+            # its box
+            if g.y >= height:
+                return False
+            for type,text,style in self.text.content:
+                if type == "text" and text.strip() and style.color[3] > 0:
+                    return True
+            return False
+        if self.path is None:
+            return False
+        fill = self.style.get("fill")
+        stroke = self.style.get("stroke")
+        if fill is None or fill[3] <= 0:
+            if stroke is None or stroke.color[3] <= 0:
+                return False
+        bounds = self.bounds()
+        if bounds is None:
+            return False
+        x1,y1,x2,y2 = bounds
+        return x2 > 0 and y2 > 0 and x1 < width and y1 < height
+
+    def bounds(self):
+        """ Returns the area (x1,y1,x2,y2) this drawable draws into, or None
+            if it isn't known (text, which may overflow its box) """
+        if self.has_text() or self.path is None:
+            return None
+        bounds = self.path.bounds()
+        if bounds is None:
+            return None
+        g = self.geometry
+        stroke = self.style.get("stroke")
+        margin = 0
+        if stroke is not None:
+            # leave room for line width and miter joins
+            margin = stroke.width / 2 * max(1, stroke.miter_limit or 1)
+        x1,y1,x2,y2 = bounds
+        return (g.x + x1 - margin, g.y + y1 - margin,
+                g.x + x2 + margin, g.y + y2 + margin)
+
+    def covers(self, width, height):
+        return False
+
+    def complexity(self):
+        """ Returns (number of path segments, number of image pixels) """
+        return len(self.path.segments()) if self.path else 0, 0
+
+    def content_key(self):
+        """ Returns a hashable value that is the same for all drawables
+            that render identically """
+        g = self.geometry
+        stroke = self.style.get("stroke")
+        runs = tuple((type, text, style.key)
+                     for type,text,style in self.text.content) if self.text else None
+        return ("shape", g.x, g.y, g.width, g.height,
+                self.style.get("fill"), stroke.key() if stroke else None,
+                tuple(self.path.beziers) if self.path else None,
+                runs)
 
     def render(self, device):
         if not self.has_text():
@@ -976,6 +1713,31 @@ class Media(object):
         self.style = style
         self.bitmap = bitmap
 
+    def complexity(self):
+        return 0, self.bitmap.pixels()
+
+    def content_key(self):
+        g = self.geometry
+        return ("media", g.x, g.y, g.width, g.height, self.bitmap.path)
+
+    def is_visible(self, width, height):
+        g = self.geometry
+        return g.x2 > max(g.x1, 0) and g.y2 > max(g.y1, 0) and \
+               g.x1 < width and g.y1 < height and \
+               self.bitmap.header() is not None
+
+    def bounds(self):
+        g = self.geometry
+        return g.x1, g.y1, g.x2, g.y2
+
+    def covers(self, width, height):
+        g = self.geometry
+        return g.x2 >= width and g.y2 >= height and \
+               self.bitmap.covers(g.x1, g.y1, width, height)
+
+    def images(self):
+        return [self.bitmap]
+
     def render(self, device):
         g = self.geometry
 
@@ -996,6 +1758,81 @@ class Media(object):
         device.line_to(g.x1,g.y1)
         device.fill()
 
+class Background(object):
+    """ The slide-fill of a slide or master slide, as a display list item """
+    key = None
+
+    def __init__(self, fill):
+        self.fill = fill
+
+    def is_visible(self, width, height):
+        return self.fill is not None and self.fill.is_visible()
+
+    def covers(self, width, height):
+        return self.fill is not None and self.fill.covers(width, height)
+
+    def images(self):
+        return self.fill.images() if self.fill is not None else []
+
+    def bounds(self):
+        return None # the whole page
+
+    def render(self, device):
+        self.fill.render(device, Index.current.width, Index.current.height)
+
+class MasterLayer(object):
+    """ The master slide of a slide, as a display list item """
+    key = None
+
+    def __init__(self, master):
+        self.master = master
+
+    def is_visible(self, width, height):
+        return len(self.master.display_list()) > 0
+
+    def covers(self, width, height):
+        return self.master.covers(width, height)
+
+    def images(self):
+        return self.master.images()
+
+    def bounds(self):
+        return None # the whole page
+
+    def render(self, device):
+        self.master.replay(device)
+
+class Thumbnail(object):
+    """ A preview image of a slide, rendered by Keynote.
+
+        Example data:
+
+        <key:thumbnails>
+          <sf:data sfa:ID="SFEData-5" sf:path="thumbs/st0.tiff" sf:displayname="st0.tiff" sf:resource-type="0" sf:hfs-type="0" sf:size="24102"/>
+        </key:thumbnails>
+    """
+    def __init__(self, nr, path):
+        self.nr = nr
+        self.path = path
+
+    @staticmethod
+    def read(xml, nr):
+        thumbnails = xml.find(ns("key:thumbnails"))
+        if thumbnails is None:
+            return None
+        for data in thumbnails.iter("sf:data"):
+            return Thumbnail(nr, data.get(ns("sf:path")))
+        return None
+
+    def image(self, size=None):
+        data = Keynote.read_file(self.path)
+        if data is None:
+            return None
+        im = Image.open(BytesIO(data))
+        if size is not None:
+            im.thumbnail(size)
+        return im
+
 class Slide(object):
     """
       <key:slide>
@@ -1025,6 +1862,10 @@ class Slide(object):
         self.stylesheet = Stylesheet.find_in_tag(xml)
         self.parse_page()
         self.master = self.parse_master()
+        self.recording = None
+        self._display_list = None
+        self._spatial_index = None
+        self.stats = {}
         info(" master slide: %s" % self.master)
 
         if self.stylesheet is None:
@@ -1033,10 +1874,17 @@ class Slide(object):
             info("  Slide stylesheet: %s" % self.stylesheet.id)
 
     def parse_master(self):
+        if Keynote.current.mode == TEXT:
+            return None
         master_ref = self.xml.find(ns("key:master-ref"))
         if master_ref is None:
             return None
-        return Index.master_slides[master_ref.get(ns("sfa:IDREF"))]
+        return Index.get_master_slide(master_ref.get(ns("sfa:IDREF")))
+
+    def add_drawable(self, drawable):
+        drawable.key = drawable.content_key()
+        Index.drawable_count[drawable.key] = Index.drawable_count.get(drawable.key, 0) + 1
+        self.drawables.append(drawable)
 
     def parse_drawable(self, e):
         if e.tag == ns("sf:shape"):
@@ -1044,7 +1892,7 @@ class Slide(object):
             style = StyleState.read(e, self.stylesheet)
             path = Path.read(e)
             text = Text.read(e, style)
-            self.drawables.append(Drawable(geometry, style, path, text))
+            self.add_drawable(Drawable(geometry, style, path, text))
         elif e.tag == ns("sf:media"):
             geometry = Geometry.read(e)
             style = StyleState.read(e, self.stylesheet)
@@ -1056,7 +1904,7 @@ class Slide(object):
                  .find_or_lookup(ns("sf:filtered-image"))
             image = Bitmap.read(f)
 
-            self.drawables.append(Media(geometry, style, image))
+            self.add_drawable(Media(geometry, style, image))
         elif e.tag == ns("sf:group"):
             for child in e:
                 self.parse_drawable(child)
@@ -1088,23 +1936,157 @@ class Slide(object):
             for e in drawable:
                 self.parse_drawable(e)
 
-    def _render_background(self, device):
-        styles = self.stylesheet.top_level_styles
-        fill = styles.get("slide-fill")
-        fill.render(device, Index.current.width, Index.current.height)
+    def text(self):
+        """ Returns the text of all text boxes on this slide """
+        return [drawable.text.plain_text() for drawable in self.drawables
+                if getattr(drawable, "text", None) is not None]
+
+    def display_list(self):
+        """ Returns everything this slide renders, in z-order, except for
+            items that are invisible, or covered by an opaque item that
+            spans the whole page (e.g., the master slide below an opaque
+            slide background). """
+        if self._display_list is not None:
+            return self._display_list
+        width, height = Index.current.width, Index.current.height
+        items = []
+        if self.nr is not None and self.master is not None:
+            items.append(MasterLayer(self.master))
+        items.append(Background(self.stylesheet.top_level_styles.get("slide-fill")))
+        items += self.drawables
+
+        first = 0
+        for i in reversed(range(len(items))):
+            if items[i].covers(width, height):
+                first = i
+                break
+        visible = [item for item in items[first:] if item.is_visible(width, height)]
+
+        self.stats["items"] = len(items)
+        self.stats["occluded"] = first
+        self.stats["invisible"] = len(items) - first - len(visible)
+        if len(visible) < len(items):
+            info("  culled %d of %d items (%d occluded)" % (
+                 len(items) - len(visible), len(items), first))
+        self._display_list = visible
+        return visible
+
+    def covers(self, width, height):
+        return any(item.covers(width, height) for item in self.display_list())
+
+    def complexity(self):
+        """ Returns an estimate of how expensive this slide is to draw (and,
+            for PDFs, to display): the number of drawing operations, with one
+            operation per drawable and per path segment, plus one for every
+            IMAGE_PIXELS_PER_OPERATION pixels of images. The master slide is
+            not included, since it's only drawn once per document. """
+        drawables = segments = pixels = 0
+        for item in self.display_list():
+            if hasattr(item, "complexity"):
+                drawables += 1
+                s,p = item.complexity()
+                segments += s
+                pixels += p
+        self.stats["drawables"] = drawables
+        self.stats["segments"] = segments
+        self.stats["image_pixels"] = int(pixels)
+        return drawables + segments + int(pixels) // IMAGE_PIXELS_PER_OPERATION
+
+    def should_flatten(self):
+        """ Returns True if this slide is too complex (see complexity()) to
+            be output as vector graphics, according to the max_complexity
+            option. """
+        if not options.max_complexity:
+            return False
+        complexity = self.complexity()
+        if complexity <= options.max_complexity:
+            return False
+        info("Slide %d: complexity %d (%d drawables, %d path segments, "
+             "%d image pixels) exceeds %d, rasterizing at %d dpi" % (
+             self.nr, complexity, self.stats["drawables"], self.stats["segments"],
+             self.stats["image_pixels"], options.max_complexity, flatten_dpi()))
+        return True
+
+    def render_flattened(self, device, recording):
+        """ Draw a recording of this slide (see record()) into an image
+            (with a resolution given by the flatten_dpi option), and draw
+            the image. """
+        scale = flatten_dpi() / 72.0
+        width, height = Index.current.width, Index.current.height
+        Budget.allocate_current(int(width * scale * height * scale * 4))
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     int(math.ceil(width * scale)),
+                                     int(math.ceil(height * scale)))
+        image = Device(cairo.Context(surface))
+        image.scale(scale, scale)
+        replay(image, recording)
+        surface.flush()
+        device.save()
+        device.scale(1 / scale, 1 / scale)
+        device.set_source_surface(surface, 0, 0)
+        device.paint()
+        device.restore()
+
+    def spatial_index(self):
+        """ Returns a GridIndex of the bounds of all display list items """
+        if self._spatial_index is None:
+            self._spatial_index = utils.GridIndex((0, 0, Index.current.width,
+                                                   Index.current.height))
+            for i,item in enumerate(self.display_list()):
+                self._spatial_index.insert(i, item.bounds())
+        return self._spatial_index
+
+    def render_area(self, device, x1, y1, x2, y2):
+        """ Render only the part of this slide within the given area, and
+            only the items that intersect it. """
+        items = self.display_list()
+        device.save()
+        device.rectangle(x1, y1, x2 - x1, y2 - y1)
+        device.clip()
+        for i in self.spatial_index().query(x1, y1, x2, y2):
+            self._render_drawable(device, items[i])
+        device.restore()
+
+    def replay(self, device):
+        """ Render a master slide. The master slide's drawables are only
+            rendered once, into a recording that is replayed for every
+            slide that uses it. """
+        if self.recording is None:
+            self.recording = record(self._render_drawables,
+                                    Index.current.width, Index.current.height)
+        for bitmap in self.images():
+            bitmap.charge()
+        replay(device, self.recording)
+
+    def images(self):
+        """ Returns the Bitmaps drawn by this slide """
+        return [bitmap for item in self.display_list() for bitmap in item.images()]
 
     def render(self, device):
-        if self.master is not None:
-            self.master._render_drawables(device)
         self._render_drawables(device)
-        device.show_page()
     
     def _render_drawables(self, device):
         # FIXME: do both the master-slide as well as the slide get to
         #        render their background color?
-        self._render_background(device)
-        for drawable in self.drawables:
+        for drawable in self.display_list():
+            Budget.check_current()
+            self._render_drawable(device, drawable)
+
+    def _render_drawable(self, device, drawable):
+        """ Drawables that occur more than once in the document (logos,
+            footers, ...) are rendered only once, and then replayed from a
+            recording, so PDFs contain them only once as well. """
+        if drawable.key is None or Index.drawable_count[drawable.key] < 2:
             drawable.render(device)
+            return
+        recording = Index.drawable_recordings.get(drawable.key)
+        if recording is None:
+            recording = record(drawable.render,
+                               Index.current.width, Index.current.height)
+            Index.drawable_recordings[drawable.key] = recording
+        for bitmap in drawable.images():
+            bitmap.charge()
+        replay(device, recording)
 
     def __str__(self):
         return self.xml.shorttag + " (" + self.id + ")"
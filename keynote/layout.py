@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import logging
+import numpy
+from . import utils
+
+warn = logging.getLogger('keynote').warn
+
+# change this whenever layout results change, to invalidate cached layouts
+LAYOUT_VERSION = 2
+
+class Line(object):
+    """ A line of laid out text: glyph indices, and glyph x positions
+        relative to the start of the line """
+    def __init__(self, indices, xs, width):
+        self.indices = indices
+        self.xs = xs
+        self.width = width
+
+    def draw(self, device, x, y):
+        """ Draw the line with its first glyph at (x,y). The font face and
+            size need to be set on the device already. """
+        n = len(self.indices)
+        if n:
+            device.show_glyphs(list(zip(self.indices.tolist(),
+                                        (self.xs + x).tolist(), [y] * n)))
+
+class Run(object):
+    """ The lines of a text run, with the font they're drawn in.
+        Every line is stored as (x, y, Line), relative to the text box. """
+    def __init__(self, font_name, font_size, color):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.color = color
+        self.lines = []
+
+class LayoutResult(object):
+    """ The laid out text of a text box, as a list of Runs.
+        Layout results only contain plain data, so they can be converted
+        to and from JSON. """
+    def __init__(self):
+        self.runs = []
+
+    def add_run(self, font_name, font_size, color):
+        run = Run(font_name, font_size, color)
+        self.runs.append(run)
+        return run
+
+    def to_json(self):
+        return json.dumps([[run.font_name, run.font_size, run.color,
+                            [[float(x), float(y), line.indices.tolist(),
+                              line.xs.tolist(), float(line.width)]
+                             for x,y,line in run.lines]]
+                           for run in self.runs])
+
+    @staticmethod
+    def from_json(data):
+        result = LayoutResult()
+        for font_name,font_size,color,lines in json.loads(data):
+            run = result.add_run(font_name, font_size,
+                                 tuple(color) if color is not None else None)
+            for x,y,indices,xs,width in lines:
+                run.lines.append((x, y, Line(numpy.array(indices, dtype=numpy.int64),
+                                             numpy.array(xs, dtype=float), width)))
+        return result
+
+class LayoutCache(object):
+    """ Stores layout results on disk, so that text boxes that didn't change
+        don't need to be laid out again in later conversions.
+        Entries are JSON files named by the hash of their key; they're
+        written to a temporary file first, so that processes can share the
+        directory. Files that can't be read as a layout result (e.g. from
+        an older version) count as misses. If entries can't be written
+        (e.g. the directory is read-only or full), the cache is only read
+        from. """
+    current = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.writable = True
+        try:
+            utils.mkdir_p(directory)
+        except OSError as e:
+            warn("Couldn't create layout cache %s: %s" % (directory, e))
+            self.writable = False
+
+    @staticmethod
+    def hash(key):
+        return hashlib.sha1(repr((LAYOUT_VERSION, key)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, LayoutCache.hash(key)), "r") as fi:
+                result = LayoutResult.from_json(fi.read())
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        if not self.writable:
+            return
+        filename = os.path.join(self.directory, LayoutCache.hash(key))
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            with open(tmpfile, "w") as fo:
+                fo.write(result.to_json())
+            os.rename(tmpfile, filename)
+        except (IOError, OSError) as e:
+            warn("Couldn't write to layout cache %s: %s" % (self.directory, e))
+            self.writable = False
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+
+def break_lines(starts, ends, width):
+    """ Greedy line breaking. Given the x positions where words start and
+        end (as increasing arrays), returns (first word, last word) of every
+        line, so that lines are at most width wide. Words that are wider than
+        a line get a line of their own. """
+    lines = []
+    first = 0
+    while first < len(starts):
+        # the last word that still ends within the line
+        last = numpy.searchsorted(ends, starts[first] + width, side="right") - 1
+        last = max(last, first)
+        lines.append((first, last))
+        first = last + 1
+    return lines
+
+def layout_text(font, text, width):
+    """ Lay out a run of text in a cairo.ScaledFont (or a
+        fontface.CachedScaledFont), breaking lines at spaces, so that
+        they're at most width wide.
+        The text is converted into glyphs only once, and line breaks are
+        computed from the glyph positions. """
+    glyphs = font.text_to_glyphs(0, 0, text, False)
+    if not glyphs:
+        return [Line(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), 0)]
+    indices = numpy.array([glyph[0] for glyph in glyphs], dtype=numpy.int64)
+    # glyph positions, plus the position after the last glyph
+    positions = numpy.append(numpy.array([glyph[1] for glyph in glyphs]),
+                             font.text_extents(text)[4])
+
+    space = font.text_to_glyphs(0, 0, " ", False)[0][0]
+    word = indices != space
+    before = numpy.append(False, word[:-1])
+    after = numpy.append(word[1:], False)
+    starts = numpy.flatnonzero(word & ~before)
+    ends = numpy.flatnonzero(word & ~after) + 1
+    if not len(starts):
+        # only spaces: still takes up a line
+        return [Line(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), 0)]
+
+    lines = []
+    for first,last in break_lines(positions[starts], positions[ends], width):
+        start = positions[starts[first]]
+        g1, g2 = starts[first], ends[last]
+        lines.append(Line(indices[g1:g2], positions[g1:g2] - start,
+                          positions[g2] - start))
+    return lines
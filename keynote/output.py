@@ -0,0 +1,205 @@
+import os
+import math
+import cairo
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from . import utils
+from .device import Device
+from .pdf import PDF
+
+class Output(object):
+    """ Base class for the files a Keynote can be rendered into.
+
+        An output only stores its settings until begin() is called, so that
+        it can be sent to another process.
+        The resolution (dpi) and the number of bands are only used by raster
+        outputs.
+    """
+    # whether parts rendered in different processes need to be joined
+    # afterwards, in the order of the slides
+    joined = False
+    # whether this output keeps vector graphics as such
+    vector = True
+
+    def __init__(self, filename, dpi=72, bands=1):
+        self.filename = filename
+        self.dpi = dpi
+        self.bands = bands
+
+    def needs_recording(self):
+        """ Whether slides should be passed to replay_page() as a recording,
+            instead of being rendered into the device from begin_page() """
+        return False
+
+    def begin(self, width, height):
+        """ Called once, before the first page, with the page size """
+        self.width = width
+        self.height = height
+        if isinstance(self.filename, str) and os.path.dirname(self.filename):
+            utils.mkdir_p(os.path.dirname(self.filename))
+
+    def begin_page(self, nr):
+        """ Returns the device to render slide nr into """
+        raise NotImplementedError()
+
+    def replay_page(self, nr, recording):
+        """ Draw slide nr from a recording surface of the whole slide """
+        device = self.begin_page(nr)
+        device.set_source_surface(recording, 0, 0)
+        device.paint()
+
+    def end_page(self, nr):
+        pass
+
+    def finish(self):
+        pass
+
+    def part(self, prefix):
+        """ Returns the output that renders a part of the slides into,
+            when rendering in multiple processes """
+        return self
+
+    def join(self, parts):
+        """ Combines the outputs returned by part(), after rendering """
+        pass
+
+    def check_filename(self, count):
+        """ Raises ValueError if the filename can't be used for rendering
+            count slides """
+        if not self.joined:
+            utils.check_pattern(self.filename, count)
+
+    def page_filename(self, nr):
+        return self.filename % nr if "%" in self.filename else self.filename
+
+class PDFOutput(Output):
+    """ A PDF document, with one page per slide. The filename may also be a
+        file object. """
+    joined = True
+
+    def begin(self, width, height):
+        Output.begin(self, width, height)
+        self.surface = cairo.PDFSurface(self.filename, width, height)
+        self.device = Device(cairo.Context(self.surface))
+
+    def begin_page(self, nr):
+        return self.device
+
+    def end_page(self, nr):
+        self.device.show_page()
+
+    def finish(self):
+        self.surface.finish()
+
+    def part(self, prefix):
+        return PDFOutput(prefix + ".pdf")
+
+    def join(self, parts):
+        pdf = PDF.load(parts[0].filename)
+        for part in parts[1:]:
+            pdf.append(PDF.load(part.filename))
+        if isinstance(self.filename, str):
+            pdf.save(self.filename)
+        else:
+            pdf.write(self.filename)
+
+# how much smaller than the page the image is that PNGOutput.replay_page()
+# replays recordings into before drawing the bands
+WARMUP_REDUCTION = 16
+
+class PNGOutput(Output):
+    """ One PNG image per slide. The filename is a pattern like
+        "slide-%d.png", which gets the slide number filled in.
+        With more than one band, every page is split into horizontal bands
+        that are drawn in parallel threads. """
+    vector = False
+
+    def needs_recording(self):
+        return self.bands > 1
+
+    def _size(self):
+        scale = self.dpi / 72.0
+        return (scale, int(math.ceil(self.width * scale)),
+                int(math.ceil(self.height * scale)))
+
+    def begin_page(self, nr):
+        scale, width, height = self._size()
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        device = Device(cairo.Context(self.surface))
+        device.scale(scale, scale)
+        return device
+
+    def replay_page(self, nr, recording):
+        """ Replays the recording into each band in a thread of its own.
+            Drawing a recording happens entirely in cairo, which doesn't hold
+            the GIL, so the threads run in parallel. The bands are images
+            on consecutive rows of one buffer, so they don't need to be
+            copied together afterwards.
+
+            cairo only guarantees that different threads can use different
+            objects at the same time (reference counts and cairo's global
+            caches are locked). A recording that's used as a source in
+            several threads is only read, except for the state cairo
+            builds lazily the first time its commands are replayed: the
+            index of the recording, and that of every recording or pattern
+            nested in it. So before the threads share the recording, it's
+            replayed once, in this thread, into a small image that covers
+            the whole page, which reaches every command of the page. """
+        scale, width, height = self._size()
+        preview_scale = scale / WARMUP_REDUCTION
+        preview = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     int(math.ceil(width / float(WARMUP_REDUCTION))),
+                                     int(math.ceil(height / float(WARMUP_REDUCTION))))
+        context = cairo.Context(preview)
+        context.scale(preview_scale, preview_scale)
+        context.set_source_surface(recording, 0, 0)
+        context.paint()
+        preview.finish()
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        buffer = numpy.zeros((height, stride), dtype=numpy.uint8)
+        rows = utils.split(list(range(height)), self.bands)
+        def draw_band(rows):
+            band = cairo.ImageSurface.create_for_data(buffer[rows[0]:rows[-1] + 1],
+                                                      cairo.FORMAT_ARGB32,
+                                                      width, len(rows), stride)
+            context = cairo.Context(band)
+            context.translate(0, -rows[0])
+            context.scale(scale, scale)
+            context.set_source_surface(recording, 0, 0)
+            context.paint()
+            band.finish()
+        with ThreadPoolExecutor(len(rows)) as pool:
+            list(pool.map(draw_band, rows))
+        self.surface = cairo.ImageSurface.create_for_data(buffer, cairo.FORMAT_ARGB32,
+                                                          width, height, stride)
+
+    def end_page(self, nr):
+        self.surface.write_to_png(self.page_filename(nr))
+        self.surface = None
+
+class SVGOutput(Output):
+    """ One SVG image per slide. The filename is a pattern like
+        "slide-%d.svg", which gets the slide number filled in. """
+    def begin_page(self, nr):
+        self.surface = cairo.SVGSurface(self.page_filename(nr), self.width, self.height)
+        return Device(cairo.Context(self.surface))
+
+    def end_page(self, nr):
+        self.surface.finish()
+        self.surface = None
+
+FORMATS = {
+    "pdf": PDFOutput,
+    "png": PNGOutput,
+    "svg": SVGOutput,
+}
+
+def create_output(filename, format=None, **kwargs):
+    """ Create an output for a filename. Unless given explicitly, the format
+        is determined from the file extension. Other arguments (dpi, bands)
+        are passed to the output. """
+    if format is None:
+        format = os.path.splitext(filename)[1][1:].lower()
+    if format not in FORMATS:
+        raise ValueError("unknown output format: %s" % format)
+    return FORMATS[format](filename, **kwargs)
@@ -1247,6 +1247,47 @@ class PDF(RawPDF):
         with open(filename, "wb") as fi:
             self.write(fi)
 
+    def append(self, other):
+        """ Append all pages of another PDF to this one.
+            The objects of the other file are copied over, and renumbered
+            so that their IDs don't collide with the ones of this file. """
+        if other.encrypt:
+            raise PDFMalformedException("can't append pages of an encrypted PDF")
+        offset = self._last_object_id
+
+        def renumber(value):
+            if isinstance(value, ID):
+                return ID(value.id + offset, value.gen)
+            elif isinstance(value, PDFArray):
+                return PDFArray([renumber(v) for v in value.a])
+            elif isinstance(value, PDFDict):
+                return PDFDict(renumber(value.d))
+            elif type(value) == dict:
+                return {k: renumber(v) for k,v in value.items()}
+            elif type(value) == list:
+                return [renumber(v) for v in value]
+            return value
+
+        skip = [other.root.id]
+        if other.info is not None:
+            skip.append(other.info.id)
+        for id in list(other.xref.keys()):
+            if not other.xref[id] or id in skip:
+                continue
+            obj = other.get_object(id)
+            if obj.get_type() in ["/XRef","/ObjStm"]:
+                continue
+            obj.file = self
+            obj.id = ID(id.id + offset, id.gen)
+            obj.d = renumber(obj.d)
+            self.xref[obj.id] = 0
+            self.id2object_cache[obj.id] = obj
+        for page in other.pages:
+            page.file = self
+            page.d = renumber(page.d)
+            self.pages.append(page)
+        self._last_object_id = offset + other._last_object_id
+
 if __name__ == "__main__":
     p = PDF.load("test.pdf")
     p.decompress()
@@ -1,5 +1,6 @@
 import os
 import sys
+import math
 import random
 from contextlib import contextmanager
 from tempfile import mkdtemp, gettempdir
@@ -109,6 +110,20 @@ def tempdir(prefix):
     finally:
         shutil.rmtree(dir)
 
+def check_pattern(pattern, count):
+    """ Raises ValueError unless pattern (like "slide-%d.png") can be used
+        to name count files, one per slide number """
+    if "%" not in pattern:
+        if count > 1:
+            raise ValueError("%s would be overwritten by every slide, use a "
+                             "pattern like slide-%%d.png" % pattern)
+        return
+    try:
+        pattern % 1
+    except (TypeError, ValueError):
+        raise ValueError("invalid filename pattern %s, use a pattern like "
+                         "slide-%%d.png" % pattern)
+
 def invert_dict(d):
     """ Invert a dictionary. For example, {'a': 3, 'b': 4} will get
         converted to {3: 'a', 4: 'b'} """
@@ -136,6 +151,66 @@ def group_by(array, f=id):
             group.append(e)
     yield group
 
+def split(array, n):
+    """ Split an array into (at most) n consecutive parts of roughly
+        equal size. For example, split([1,2,3,4,5], 2) returns [[1,2,3],[4,5]].
+    """
+    n = max(1, min(n, len(array)))
+    size, rest = divmod(len(array), n)
+    parts = []
+    pos = 0
+    for i in range(n):
+        end = pos + size + (1 if i < rest else 0)
+        parts.append(array[pos:end])
+        pos = end
+    return [part for part in parts if len(part)]
+
+class GridIndex:
+    """ A spatial index of rectangles (x1,y1,x2,y2), for quickly finding
+        all rectangles that intersect a given area. Every rectangle is
+        stored in all cells of a uniform grid that it touches.
+        Rectangles can also be None (unknown size), in which case they match
+        every query.
+        The grid only covers the given extent (x1,y1,x2,y2): rectangles and
+        queries are clamped to it, so that everything outside of it ends up
+        in the cells along its border. """
+    def __init__(self, extent, cell_size=64):
+        self.extent = extent
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.rects = {}
+        self.unbounded = []
+
+    def _cells(self, x1, y1, x2, y2):
+        ex1, ey1, ex2, ey2 = self.extent
+        x1, x2 = [min(max(x, ex1), ex2) for x in (x1, x2)]
+        y1, y2 = [min(max(y, ey1), ey2) for y in (y1, y2)]
+        s = self.cell_size
+        for cx in range(int(x1 // s), int(x2 // s) + 1):
+            for cy in range(int(y1 // s), int(y2 // s) + 1):
+                yield cx, cy
+
+    def insert(self, key, rect):
+        """ Add a rectangle. Keys are returned by query(), and need to be
+            sortable. """
+        if rect is None or any(math.isnan(x) for x in rect):
+            self.unbounded.append(key)
+            return
+        self.rects[key] = rect
+        for cell in self._cells(*rect):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query(self, x1, y1, x2, y2):
+        """ Returns the (sorted) keys of all rectangles that intersect the
+            given area """
+        found = set(self.unbounded)
+        for cell in self._cells(x1, y1, x2, y2):
+            for key in self.cells.get(cell, ()):
+                rx1, ry1, rx2, ry2 = self.rects[key]
+                if rx1 < x2 and ry1 < y2 and rx2 > x1 and ry2 > y1:
+                    found.add(key)
+        return sorted(found)
+
 def shorten_warnings():
     """ Configure the warning module to output more dense warnings that
         (usually) fit into a single line """
@@ -151,6 +226,9 @@ class NumericRange:
             object that can be used to query existence of individual integers."""
         r = []
         for item in s.split(","):
+            item = item.strip()
+            if not item:
+                continue
             if "-" in item:
                 # range, e.g. "1-5", or "1-"
                 numbers = item.split("-")
@@ -189,6 +267,13 @@ class NumericRange:
             return True
         return False
 
+    def last(self):
+        """ returns the largest integer in this NumericRange (sys.maxsize
+            for open ranges like "7-", and 0 for empty ranges) """
+        if not self.ranges:
+            return 0
+        return self.ranges[-1][0]
+
 @lru_cache()
 def parse_range(range_string):
     """ Parses ranges like "1,2-5,7-" and returns an object
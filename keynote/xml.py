@@ -163,6 +163,78 @@ def XML(data):
     Element.fill_registry(root)
     return Element(root)
 
+class ReferenceCollector(object):
+    """ lxml parser target that collects the values of a set of attributes
+        (e.g. sfa:IDREF), without building a tree. """
+    def __init__(self, attributes, tag=None, max_count=None):
+        self.attributes = [ns(a) for a in attributes]
+        self.tag = ns(tag) if tag else None
+        self.max_count = max_count
+        self.count = 0
+        self.refs = set()
+
+    @property
+    def done(self):
+        return self.max_count is not None and self.count >= self.max_count
+
+    def start(self, tag, attrib):
+        for name in self.attributes:
+            value = attrib.get(name)
+            if value is not None:
+                self.refs.add(value)
+
+    def end(self, tag):
+        if tag == self.tag:
+            self.count += 1
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.refs
+
+def collect_references(fi, attributes, tag=None, max_count=None):
+    """ Returns all values of the given attributes in an XML file.
+        If max_count is given, stop reading after that many elements with
+        the given tag have been parsed. """
+    target = ReferenceCollector(attributes, tag, max_count)
+    parser = etree.XMLParser(target=target, huge_tree=True)
+    while not target.done:
+        data = fi.read(65536)
+        if not data:
+            parser.close()
+            break
+        parser.feed(data)
+    return target.refs
+
+class XMLStream(object):
+    """ Parses an XML file incrementally.
+
+        Iterating over an XMLStream yields every element with the given tag
+        as soon as it is complete. Once the next element is requested, the
+        previous one is discarded, so apart from the part of the document
+        outside of those elements, only elements that are in the registry
+        (i.e., have one of the given IDs) are kept in memory.
+    """
+    def __init__(self, fi, tag, ids=None):
+        self.fi = fi
+        self.tag = ns(tag)
+        self.ids = ids
+        self.root = None
+
+    def __iter__(self):
+        for event, e in etree.iterparse(self.fi, events=("end",), huge_tree=True):
+            if self.root is None:
+                self.root = Element(e.getroottree().getroot())
+            id = e.get(Element.sfa_ID)
+            if id is not None and (self.ids is None or id in self.ids):
+                Element.registry[id] = e
+            if e.tag == self.tag:
+                yield Element(e)
+                e.clear()
+                while e.getprevious() is not None:
+                    del e.getparent()[0]
+
 class XMLBuild:
     """ XMLBuild allows to create xml trees by attribute access.
 
@@ -0,0 +1,48 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+from keynote.device import Device
+
+class CallLog(object):
+    """ stands in for a cairo.Context, and records all method calls """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append(name)
+        return call
+
+class DeviceTest(TestCase):
+    def test_redundant_calls(self):
+        log = CallLog()
+        device = Device(log)
+        device.set_source_rgba(0, 0, 0, 1)
+        device.set_source_rgba(0, 0, 0, 1)
+        device.set_font_size(12)
+        device.set_font_size(12)
+        device.set_line_width(2)
+        device.fill()
+        device.set_line_width(2)
+        self.assertEqual(log.calls, ["set_source_rgba", "set_font_size",
+                                     "set_line_width", "fill"])
+
+    def test_restore(self):
+        log = CallLog()
+        device = Device(log)
+        device.set_source_rgba(0, 0, 0, 1)
+        device.save()
+        device.set_source_rgba(1, 1, 1, 1)
+        device.restore()
+        device.set_source_rgba(0, 0, 0, 1)
+        device.set_source_surface(None)
+        device.set_source_rgba(0, 0, 0, 1)
+        self.assertEqual(log.calls, ["set_source_rgba", "save", "set_source_rgba",
+                                     "restore", "set_source_surface",
+                                     "set_source_rgba"])
+
+if __name__ == "__main__":
+    unittest.main()
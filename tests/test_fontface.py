@@ -0,0 +1,140 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+import shutil
+import json
+import subprocess
+import cairo
+from keynote.fontface import FontIndex, CachedScaledFont, clear_caches, cache_info, \
+                             add_embedded_font, text_extents, font_extents, FontConfig
+from keynote.layout import layout_text
+
+class FakeFontConfig(object):
+    """ stands in for fontconfig, and counts the calls """
+    def __init__(self):
+        self.calls = 0
+
+    def list_fonts(self):
+        self.calls += 1
+        return [("Arial", "Bold", "/fonts/arialbd.ttf", 0),
+                ("Arial", "Regular", "/fonts/arial.ttf", 0),
+                ("Helvetica", "Light", "/fonts/helvetica.ttc", 2)]
+
+    def match_font(self, family, style=None):
+        self.calls += 1
+        return ("/fonts/dejavu.ttf", 0)
+
+    def font_directories(self):
+        return ["_test_fonts"]
+
+class FontIndexTest(TestCase):
+    def setUp(self):
+        os.mkdir("_test_fonts")
+
+    def tearDown(self):
+        shutil.rmtree("_test_fonts")
+        os.unlink("_test_font_index.json")
+
+    def test_index(self):
+        fc = FakeFontConfig()
+        index = FontIndex("_test_font_index.json", ["_test_fonts"], fc)
+        self.assertEqual(index.find("Arial"), ("/fonts/arial.ttf", 0))
+        self.assertEqual(index.find("arial", "bold"), ("/fonts/arialbd.ttf", 0))
+        self.assertEqual(index.find("Helvetica"), ("/fonts/helvetica.ttc", 2))
+        self.assertEqual(index.find("Comic Sans MS"), ("/fonts/dejavu.ttf", 0))
+        self.assertEqual(fc.calls, 2)
+
+        # a new process reads everything from disk
+        fc = FakeFontConfig()
+        index = FontIndex("_test_font_index.json", ["_test_fonts"], fc)
+        self.assertEqual(index.find("Comic Sans MS"), ("/fonts/dejavu.ttf", 0))
+        self.assertEqual(index.find("Arial"), ("/fonts/arial.ttf", 0))
+        self.assertEqual(fc.calls, 0)
+
+    def test_invalidate(self):
+        fc = FakeFontConfig()
+        FontIndex("_test_font_index.json", ["_test_fonts"], fc).find("Arial")
+        os.utime("_test_fonts", (0, 0))
+        FontIndex("_test_font_index.json", ["_test_fonts"], fc).find("Arial")
+        self.assertEqual(fc.calls, 2)
+
+    def test_configured_directories(self):
+        fc = FakeFontConfig()
+        FontIndex("_test_font_index.json", font_config=fc).find("Arial")
+        # fonts installed into fontconfig's directories invalidate the index
+        os.mkdir("_test_fonts/new")
+        os.utime("_test_fonts", (0, 0))
+        FontIndex("_test_font_index.json", font_config=fc).find("Arial")
+        self.assertEqual(fc.calls, 2)
+
+# switches to the bundled fonts in a separate process, since that replaces
+# the font configuration of the whole process
+USE_BUNDLED_FONTS = """
+import sys, json
+sys.path.append(%r)
+from keynote.fontface import use_bundled_fonts, find_font
+use_bundled_fonts("_test_bundled_fonts")
+print(json.dumps(find_font("Helvetica-Bold")))
+""" % basedir
+
+class BundledFontsTest(TestCase):
+    def setUp(self):
+        fonts = [f for f in FontConfig().list_fonts() if f[2].endswith(".ttf")]
+        if not fonts:
+            self.skipTest("no TrueType fonts installed")
+        self.family, style, filename, index = fonts[0]
+        os.mkdir("_test_bundled_fonts")
+        os.mkdir("_test_font_cache")
+        shutil.copy(filename, "_test_bundled_fonts/font.ttf")
+        with open("_test_bundled_fonts/substitutions.json", "w") as fo:
+            json.dump({"helvetica": self.family}, fo)
+
+    def tearDown(self):
+        shutil.rmtree("_test_bundled_fonts")
+        shutil.rmtree("_test_font_cache")
+
+    def test_substitutions(self):
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.abspath("_test_font_cache"))
+        output = subprocess.check_output([sys.executable, "-c", USE_BUNDLED_FONTS], env=env)
+        filename, index = json.loads(output.decode("utf-8"))
+        self.assertEqual(filename, os.path.abspath("_test_bundled_fonts/font.ttf"))
+        # fontconfig's cache goes to the user's cache, not to the font directory
+        self.assertEqual(sorted(os.listdir("_test_bundled_fonts")),
+                         ["font.ttf", "substitutions.json"])
+        caches = [name for name in os.listdir("_test_font_cache/keynote")
+                  if name.startswith("fc-cache-")]
+        self.assertEqual(len(caches), 1)
+        self.assertTrue(os.listdir(os.path.join("_test_font_cache/keynote", caches[0])))
+
+class EmbeddedFontTest(TestCase):
+    def test_broken_font(self):
+        self.assertEqual(add_embedded_font(b"not a font", "broken.ttf"), None)
+
+class FontCacheTest(TestCase):
+    def test_text_extents(self):
+        clear_caches()
+        face = cairo.ToyFontFace("sans")
+        extents = text_extents(face, 12, "Hello")
+        self.assertEqual(text_extents(face, 12, "Hello"), extents)
+        self.assertTrue(text_extents(face, 24, "Hello")[2] > extents[2])
+        font_extents(face, 12)
+        info = cache_info()
+        self.assertEqual((info["text_extents"].hits, info["text_extents"].misses), (1, 2))
+        # one scaled font per size, shared by all measurements
+        self.assertEqual(info["scaled_fonts"].misses, 2)
+
+    def test_measurements(self):
+        clear_caches()
+        font = CachedScaledFont(cairo.ToyFontFace("sans"), 12)
+        layout_text(font, "aa bb", 1000)
+        layout_text(font, "aa bb", 10)
+        info = cache_info()
+        # the text and a space are converted to glyphs by every layout
+        self.assertEqual((info["text_glyphs"].hits, info["text_glyphs"].misses), (2, 2))
+        self.assertEqual((info["text_extents"].hits, info["text_extents"].misses), (1, 1))
+
+if __name__ == "__main__":
+    unittest.main()
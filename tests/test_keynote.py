@@ -6,45 +6,309 @@ sys.path.append(os.path.join(basedir, "keynote"))
 import unittest
 from unittest import TestCase
 import zipfile
-from keynote.xml import new_xml
-from keynote.keynote import Keynote
+import cairo
+import shutil
+from io import BytesIO
+from keynote.xml import new_xml, XMLBuild
+from keynote.keynote import Keynote, Index, Options, Budget, BudgetExceeded, \
+                           Bitmap, TextStyle, surface_array, THUMBNAILS, TEXT
 from keynote.pdf import PDF
+from keynote.output import PDFOutput, PNGOutput
+from keynote.device import Device
+from PIL import Image
 
 def add_geometry(e, w, h):
     e.sf_geometry.sf_size(sfa_w=w, sfa_h=h)
     e.sf_geometry.sf_position(sfa_x=0, sfa_y=0)
     e.sf_geometry.sf_naturalSize(sfa_w=0, sfa_h=0)
 
+def add_image(slide, filename, w, h):
+    media = slide.key_page.sf_drawables.sf_media
+    add_geometry(media, w, h)
+    unfiltered = media.sf_content.sf_image_media.sf_filtered_image.sf_unfiltered
+    unfiltered.sf_size(sfa_w="400", sfa_h="400")
+    unfiltered.sf_data(sf_path=filename)
+    return media
+
+def add_text(slide, paragraphs):
+    shape = slide.key_page.sf_drawables.sf_shape
+    add_geometry(shape, 400, 100)
+    shape.sf_path.sf_bezier_path.sf_bezier(sfa_path="M 0 0 L 400 0 L 400 100 Z")
+    storage = shape.sf_text.sf_text_storage
+    storage.key_stylesheet.sf_paragraphstyle(sfa_ID="ParagraphStyle-0")
+    for text in paragraphs:
+        p = XMLBuild("sf_p")
+        p(sf_style="ParagraphStyle-0")
+        p.TEXT(text)
+        storage.sf_text_body._append(p)
+    return shape
+
 class KeynoteTest(TestCase):
     WIDTH = 800
     HEIGHT = 600
     def setUp(self):
+        Options.settings["pages"] = "1-"
         xml = new_xml()
         p = xml.key_presentation(sfa_ID="Key-0", key_version="92008102400")
         p.key_size(sfa_w=self.WIDTH, sfa_h=self.HEIGHT)
         p.top_level_styles
-        slides = xml.key_presentation.key_slide_list
-        slide = slides.key_slide
+        p.key_theme_list.key_theme.key_master_slides
+        self.xml = xml
+        self.slide = self.add_slide() # first slide
+
+    def add_slide(self):
+        slide = XMLBuild("key_slide")
+        self.xml.key_presentation.key_slide_list._append(slide)
         slide.key_stylesheet.sf_slide_style.sf_fill.sf_color(sfa_w="0.0", sfa_a="0.0")
         slide.key_page.sf_drawables
-        
-        self.xml = xml
-        self.slide = slide # first slide
+        return slide
 
-    def convert(self, extra_files=[]):
+    def convert(self, extra_files=[], **kwargs):
         z = zipfile.ZipFile("_test.key", "w")
         z.writestr("index.apxl", str(self.xml))
         for filename in extra_files:
             z.write(os.path.join("tests/files/",filename), filename)
         z.close()
         k = Keynote("_test.key")
-        k.save("_test.pdf")
+        k.save("_test.pdf", **kwargs)
         return PDF.load("_test.pdf")
 
     def test_empty(self):
         pdf = self.convert()
         self.assertEqual(list(pdf.pages[0]["MediaBox"]), [0,0,self.WIDTH,self.HEIGHT])
 
+    def add_master_slide(self, id):
+        master = XMLBuild("key_master_slide")
+        master(sfa_ID=id)
+        master.key_stylesheet.sf_slide_style.sf_fill.sf_color(sfa_w="0.0", sfa_a="0.0")
+        master.key_page.sf_drawables
+        self.xml.key_presentation.key_theme_list.key_theme.key_master_slides._append(master)
+        return master
+
+    def test_master_slide(self):
+        master = self.add_master_slide("MasterSlide-0")
+        add_image(master, "baboon.png", 512, 512)
+        self.slide.key_master_ref(sfa_IDREF="MasterSlide-0")
+        self.add_slide().key_master_ref(sfa_IDREF="MasterSlide-0")
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key")
+        self.assertEqual(len(Index.master_slides), 1)
+        master = k.get_slide(1).master
+        self.assertTrue(k.get_slide(2).master is master)
+
+        pixels = k.render_slide_array(1).copy()
+        recording = master.recording
+        self.assertTrue(recording is not None)
+        self.assertEqual(k.render_slide_array(2).tobytes(), pixels.tobytes())
+        self.assertTrue(master.recording is recording)
+
+        # same pixels as drawing the master slide without a recording
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.WIDTH, self.HEIGHT)
+        master.render(Device(cairo.Context(surface)))
+        surface.flush()
+        self.assertEqual(surface_array(surface).tobytes(), pixels.tobytes())
+
+    def test_parallel(self):
+        self.add_slide()
+        self.add_slide()
+        pdf = self.convert(jobs=2)
+        self.assertEqual(len(pdf.pages), 3)
+
+    def test_parallel_file_object(self):
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        fo = BytesIO()
+        k.save_as([PDFOutput(fo)], jobs=2)
+        self.assertEqual(len(PDF(str(fo.getvalue(), "latin-1")).pages), 2)
+
+    def test_iter_pages(self):
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        pages = list(k.iter_pages())
+        self.assertEqual([nr for nr,data in pages], [1, 2])
+        for nr,data in pages:
+            pdf = PDF(str(data, "latin-1"))
+            self.assertEqual(len(pdf.pages), 1)
+
+    def test_multiple_outputs(self):
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        k.save_as([PDFOutput("_test.pdf"), PNGOutput("_test-%d.png")])
+        self.assertEqual(len(PDF.load("_test.pdf").pages), 2)
+        for nr in [1, 2]:
+            image = Image.open("_test-%d.png" % nr)
+            self.assertEqual(image.size, (self.WIDTH, self.HEIGHT))
+            os.unlink("_test-%d.png" % nr)
+
+    def test_parallel_images(self):
+        self.add_slide()
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        k.save_as([PNGOutput("_test_out/%d.png", dpi=144)], jobs=2)
+        for nr in [1, 2, 3]:
+            image = Image.open("_test_out/%d.png" % nr)
+            self.assertEqual(image.size, (self.WIDTH*2, self.HEIGHT*2))
+        shutil.rmtree("_test_out")
+
+    def test_bands(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key")
+        k.save_as([PNGOutput("_test-%d.png"), PNGOutput("_test-banded-%d.png", bands=3)])
+        image1 = Image.open("_test-1.png")
+        image2 = Image.open("_test-banded-1.png")
+        self.assertEqual(image1.tobytes(), image2.tobytes())
+        os.unlink("_test-1.png")
+        os.unlink("_test-banded-1.png")
+
+    def test_output_pattern(self):
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        self.assertRaises(ValueError, k.save_as, [PNGOutput("_test.png")], jobs=2)
+
+    def test_slide_arrays(self):
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key")
+        pixels = k.render_slide_array(1, scale=0.5)
+        self.assertEqual(pixels.shape, (self.HEIGHT//2, self.WIDTH//2, 4))
+        self.assertEqual(pixels.max(), 0)
+        arrays = [pixels for nr,pixels in k.iter_slide_arrays([1, 2])]
+        self.assertEqual(len(arrays), 2)
+        self.assertTrue(arrays[0] is arrays[1])
+
+    def test_tiles(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key")
+        slide = k.get_slide(1)
+        self.assertEqual(len(slide.spatial_index().query(600, 520, 700, 600)), 0)
+        surface = k.render_tile(1, 1, 0, 0)
+        self.assertEqual(surface.get_width(), 256)
+        self.assertTrue(surface_array(surface).max() > 0)
+        self.assertEqual(surface_array(k.render_tile(1, 2, 3, 2)).max(), 0)
+
+    def test_flatten(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        Options.settings["max_complexity"] = 100
+        try:
+            pdf = self.convert(["baboon.png"])
+        finally:
+            del Options.settings["max_complexity"]
+        # the page is a single image of the whole slide, at 150 dpi
+        self.assertEqual(len(pdf.images()), 1)
+        self.assertEqual(pdf.images()[0]["Width"], 1667)
+
+    def test_flatten_vector_only(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key")
+        k.save_as([PNGOutput("_test-plain-%d.png")])
+        Options.settings["max_complexity"] = 100
+        try:
+            k.save_as([PDFOutput("_test.pdf"), PNGOutput("_test-%d.png")])
+        finally:
+            del Options.settings["max_complexity"]
+        self.assertEqual(PDF.load("_test.pdf").images()[0]["Width"], 1667)
+        # the png is rendered natively, not from the flattened image
+        self.assertEqual(Image.open("_test-1.png").tobytes(),
+                         Image.open("_test-plain-1.png").tobytes())
+        os.unlink("_test-1.png")
+        os.unlink("_test-plain-1.png")
+
+    def test_budget(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        slide = self.add_slide()
+        add_image(slide, "baboon.png", 512, 512)
+        # baboon.png takes up exactly 1 MB
+        Options.settings["slide_max_mem"] = 1
+        try:
+            pdf = self.convert(["baboon.png"])
+            self.assertEqual(len(pdf.images()), 1)
+            Options.settings["slide_max_mem"] = 0.5
+            pdf = self.convert(["baboon.png"])
+        finally:
+            del Options.settings["slide_max_mem"]
+        # both slides are replaced by placeholders, but still there (the
+        # second one uses the image that was already decoded for the first)
+        self.assertEqual(len(pdf.pages), 2)
+        self.assertEqual(len(pdf.images()), 0)
+
+    def test_budget_limit(self):
+        budget = Budget(max_mem=100)
+        budget.allocate(60, "a.png")
+        budget.allocate(60, "a.png")
+        budget.allocate(40)
+        self.assertRaises(BudgetExceeded, budget.allocate, 1)
+
+    def test_thumbnails(self):
+        slide = self.add_slide()
+        slide.key_thumbnails.sf_data(sf_path="baboon.png")
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key", mode=THUMBNAILS)
+        self.assertEqual(len(k.slides), 0)
+        thumbnails = list(k.thumbnails(size=(64, 64)))
+        self.assertEqual([nr for nr,image in thumbnails], [2])
+        self.assertEqual(thumbnails[0][1].size, (64, 64))
+        # a single thumbnail doesn't need a pattern
+        k.save_thumbnails("_test.png")
+        self.assertEqual(Image.open("_test.png").size, (512, 512))
+        os.unlink("_test.png")
+        slide = self.add_slide()
+        slide.key_thumbnails.sf_data(sf_path="baboon.png")
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key", mode=THUMBNAILS)
+        self.assertRaises(ValueError, k.save_thumbnails, "_test.png")
+
+    def text_styles(self, k):
+        return [style for type,text,style in k.get_slide(1).drawables[0].text.content]
+
+    def test_text_styles(self):
+        add_text(self.slide, ["Hello", "World"])
+        self.convert()
+        k = Keynote("_test.key")
+        styles = self.text_styles(k)
+        self.assertEqual(len(styles), 2)
+        self.assertTrue(styles[0] is styles[1])
+        self.assertEqual(list(TextStyle.interned.values()), [styles[0]])
+        # fonts are resolved while parsing
+        self.assertTrue(styles[0].face is not None)
+        self.assertTrue(styles[0].font_file is not None)
+        self.assertTrue(styles[0].cached_font is not None)
+        self.assertEqual(styles[0].font_name, TextStyle.DEFAULT_FONT_NAME)
+
+    def test_text_styles_unresolved(self):
+        add_text(self.slide, ["Hello"])
+        self.slide.key_thumbnails.sf_data(sf_path="baboon.png")
+        self.convert(["baboon.png"])
+        k = Keynote("_test.key", mode=TEXT)
+        style = self.text_styles(k)[0]
+        self.assertEqual((style.face, style.font_file, style.cached_font), (None, None, None))
+        Keynote("_test.key", mode=THUMBNAILS)
+        self.assertEqual(TextStyle.interned, {})
+
+    def test_extract_text(self):
+        add_text(self.slide, ["Hello", "World"])
+        self.add_slide()
+        self.convert()
+        k = Keynote("_test.key", mode=TEXT)
+        self.assertEqual(list(k.extract_text()),
+                         [{"slide": 1, "text": ["Hello\nWorld"]},
+                          {"slide": 2, "text": []}])
+
+    def test_lazy_parsing(self):
+        self.add_slide()
+        self.add_slide()
+        Options.settings["pages"] = "2"
+        pdf = self.convert()
+        self.assertEqual(len(pdf.pages), 1)
+        self.assertEqual(len(Index.stylesheets), 1)
+
     def test_images(self):
         xml = self.xml
 
@@ -58,6 +322,46 @@ class KeynoteTest(TestCase):
         self.assertEqual(pdf.images()[0]["Width"], 512)
         self.assertEqual(pdf.images()[0]["Height"], 512)
 
+    def test_transparent_image(self):
+        add_image(self.slide, "alpha.png", 64, 64)
+        self.convert(extra_files=["alpha.png"])
+        k = Keynote("_test.key")
+        pixels = k.render_slide_array(1)
+        # half transparent red, premultiplied, in cairo's B,G,R,A order
+        self.assertEqual(list(pixels[10, 10]), [0, 0, 128, 128])
+        self.assertEqual(list(pixels[100, 100]), [0, 0, 0, 0])
+
+    def test_culling(self):
+        media = add_image(self.slide, "baboon.png", 512, 512)
+        media.sf_geometry.sf_position(sfa_x=self.WIDTH + 10, sfa_y=0)
+
+        pdf = self.convert(extra_files=["baboon.png"])
+        self.assertEqual(len(pdf.images()), 0)
+
+    def test_culling_without_decoding(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        self.convert(extra_files=["baboon.png"])
+        Bitmap.filename_to_surface = {}
+        Bitmap.filename_to_header = {}
+        k = Keynote("_test.key")
+        slide = k.get_slide(1)
+        slide.display_list()
+        slide.spatial_index()
+        self.assertEqual(Bitmap.filename_to_header, {"baboon.png": (512, 512, True)})
+        # the image is only decoded when it gets drawn
+        self.assertEqual(Bitmap.filename_to_surface, {})
+        k.render_slide_array(1)
+        self.assertEqual(list(Bitmap.filename_to_surface.keys()), ["baboon.png"])
+
+    def test_shared_drawables(self):
+        add_image(self.slide, "baboon.png", 512, 512)
+        add_image(self.add_slide(), "baboon.png", 512, 512)
+
+        pdf = self.convert(extra_files=["baboon.png"])
+        self.assertEqual(len(pdf.pages), 2)
+        self.assertEqual(len(pdf.images()), 1)
+        self.assertEqual(len(pdf.objects_of_subtype("/Form")), 1)
+
 if __name__ == "__main__":
     unittest.main()
 
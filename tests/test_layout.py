@@ -0,0 +1,70 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+import numpy
+import shutil
+from keynote.layout import break_lines, layout_text, LayoutResult, LayoutCache
+
+class FakeFont(object):
+    """ stands in for a cairo.ScaledFont: every character is one glyph
+        (its character code), 10 units wide """
+    def text_to_glyphs(self, x, y, text, with_clusters):
+        return [(ord(c), x + 10 * i, y) for i,c in enumerate(text)]
+
+    def text_extents(self, text):
+        return (0, 0, 10 * len(text), 10, 10 * len(text), 0)
+
+class LayoutTest(TestCase):
+    def test_break_lines(self):
+        starts = numpy.array([0, 40, 80, 200])
+        ends = numpy.array([30, 70, 190, 230])
+        self.assertEqual(break_lines(starts, ends, 100), [(0, 1), (2, 2), (3, 3)])
+        self.assertEqual(break_lines(starts, ends, 1000), [(0, 3)])
+
+    def test_layout(self):
+        lines = layout_text(FakeFont(), "aa bb  cccc d", 60)
+        self.assertEqual(["".join(chr(i) for i in line.indices) for line in lines],
+                         ["aa bb", "cccc d"])
+        self.assertEqual([line.width for line in lines], [50, 60])
+        self.assertEqual(list(lines[1].xs), [0, 10, 20, 30, 40, 50])
+
+    def test_empty(self):
+        self.assertEqual(len(layout_text(FakeFont(), "", 60)), 1)
+        self.assertEqual(len(layout_text(FakeFont(), "   ", 60)), 1)
+
+    def test_cache(self):
+        cache = LayoutCache("_test_layout_cache")
+        try:
+            key = ((("text", "aa bb", "Arial", 12, (0, 0, 0, 1), 0),), 60)
+            self.assertEqual(cache.get(key), None)
+            result = LayoutResult()
+            run = result.add_run("Arial", 12, (0, 0, 0, 1))
+            for line in layout_text(FakeFont(), "aa bb", 60):
+                run.lines.append((0, 0, line))
+            cache.put(key, result)
+            result = cache.get(key)
+            self.assertEqual(result.runs[0].font_name, "Arial")
+            self.assertEqual(result.runs[0].lines[0][2].width, 50)
+            self.assertEqual(list(result.runs[0].lines[0][2].indices), [97, 97, 32, 98, 98])
+            self.assertEqual(result.runs[0].color, (0, 0, 0, 1))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # anything that isn't a layout result is a miss
+            with open(os.path.join("_test_layout_cache", LayoutCache.hash(key)), "w") as fo:
+                fo.write("[[1]]")
+            self.assertEqual(cache.get(key), None)
+        finally:
+            shutil.rmtree("_test_layout_cache")
+
+    def test_cache_write_error(self):
+        cache = LayoutCache("_test_layout_cache")
+        shutil.rmtree("_test_layout_cache")
+        # failing to write only disables the cache
+        cache.put("key", LayoutResult())
+        self.assertFalse(cache.writable)
+        self.assertEqual(cache.get("key"), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+import json
+import zipfile
+import subprocess
+from keynote.xml import new_xml, XMLBuild
+
+# modules that text extraction must not need
+RENDERING_MODULES = ["cairo", "numpy", "PIL", "keynote.fontface",
+                     "keynote.layout", "keynote.output"]
+
+# runs key2txt with the rendering modules made unimportable
+KEY2TXT = """
+import sys, runpy
+for name in %r:
+    sys.modules[name] = None
+sys.argv = ["key2txt.py", "_test_text.key"]
+runpy.run_path(%r, run_name="__main__")
+""" % (RENDERING_MODULES, os.path.join(basedir, "bin", "key2txt.py"))
+
+class TextTest(TestCase):
+    def setUp(self):
+        xml = new_xml()
+        p = xml.key_presentation(sfa_ID="Key-0", key_version="92008102400")
+        p.key_size(sfa_w=800, sfa_h=600)
+        p.top_level_styles
+        slide = XMLBuild("key_slide")
+        p.key_slide_list._append(slide)
+        slide.key_stylesheet.sf_slide_style.sf_fill.sf_color(sfa_w="0.0", sfa_a="0.0")
+        shape = slide.key_page.sf_drawables.sf_shape
+        shape.sf_geometry.sf_size(sfa_w=400, sfa_h=100)
+        shape.sf_geometry.sf_position(sfa_x=0, sfa_y=0)
+        shape.sf_geometry.sf_naturalSize(sfa_w=0, sfa_h=0)
+        shape.sf_path.sf_bezier_path.sf_bezier(sfa_path="M 0 0 L 400 0 L 400 100 Z")
+        storage = shape.sf_text.sf_text_storage
+        storage.key_stylesheet.sf_paragraphstyle(sfa_ID="ParagraphStyle-0")
+        for text in ["Hello", "World"]:
+            paragraph = XMLBuild("sf_p")
+            paragraph(sf_style="ParagraphStyle-0")
+            paragraph.TEXT(text)
+            storage.sf_text_body._append(paragraph)
+        z = zipfile.ZipFile("_test_text.key", "w")
+        z.writestr("index.apxl", str(xml))
+        z.close()
+
+    def tearDown(self):
+        os.unlink("_test_text.key")
+
+    def test_without_rendering_modules(self):
+        output = subprocess.check_output([sys.executable, "-c", KEY2TXT])
+        slides = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+        self.assertEqual(slides, [{"slide": 1, "text": ["Hello\nWorld"],
+                                   "file": "_test_text.key"}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+from keynote.utils import GridIndex, split, parse_range, check_pattern
+
+class UtilsTest(TestCase):
+    def test_split(self):
+        self.assertEqual(split([1,2,3,4,5], 2), [[1,2,3],[4,5]])
+        self.assertEqual(split([1,2], 4), [[1],[2]])
+
+    def test_range(self):
+        self.assertTrue(parse_range("1,3-5").contains(4))
+        self.assertFalse(parse_range("1,3-5").contains(2))
+        self.assertEqual(parse_range("1,3-5").last(), 5)
+
+    def test_empty_range(self):
+        self.assertFalse(parse_range("").contains(1))
+        self.assertEqual(parse_range("").last(), 0)
+
+    def test_check_pattern(self):
+        check_pattern("slide-%d.png", 2)
+        check_pattern("slide.png", 1)
+        self.assertRaises(ValueError, check_pattern, "slide.png", 2)
+        self.assertRaises(ValueError, check_pattern, "slide-%d-%d.png", 2)
+
+    def test_grid_index(self):
+        index = GridIndex((0, 0, 100, 100), cell_size=10)
+        index.insert(0, None)
+        index.insert(1, (0, 0, 100, 100))
+        index.insert(2, (5, 5, 15, 15))
+        index.insert(3, (50, 50, 55, 55))
+        self.assertEqual(index.query(0, 0, 10, 10), [0, 1, 2])
+        self.assertEqual(index.query(16, 16, 40, 40), [0, 1])
+        self.assertEqual(index.query(52, 52, 53, 53), [0, 1, 3])
+        self.assertEqual(index.query(200, 200, 300, 300), [0])
+
+    def test_grid_index_extent(self):
+        index = GridIndex((0, 0, 100, 100), cell_size=10)
+        index.insert(1, (-1e12, -1e12, 1e12, 1e12))
+        index.insert(2, (150, 0, float("inf"), 10))
+        index.insert(3, (float("nan"), 0, 10, 10))
+        self.assertEqual(len(index.cells), 121)
+        self.assertEqual(index.query(50, 50, 60, 60), [1, 3])
+        self.assertEqual(index.query(200, 0, 300, 5), [1, 2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
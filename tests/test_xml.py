@@ -0,0 +1,40 @@
+import os
+import sys
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(basedir)
+import unittest
+from unittest import TestCase
+from io import BytesIO
+from keynote.xml import new_xml, XMLBuild, XMLStream, Element, collect_references
+
+class XMLStreamTest(TestCase):
+    def setUp(self):
+        xml = new_xml()
+        p = xml.key_presentation(sfa_ID="Key-0")
+        p.key_size(sfa_w="800", sfa_h="600")
+        for i in range(3):
+            slide = XMLBuild("key_slide")
+            slide(sfa_ID="Slide-%d" % i)
+            slide.key_page.sf_shape(sfa_ID="Shape-%d" % i)
+            slide.key_page.sf_shape_ref(sfa_IDREF="Shape-0")
+            p.key_slide_list._append(slide)
+        self.data = str(xml).encode("utf-8")
+
+    def test_collect_references(self):
+        refs = collect_references(BytesIO(self.data), ["sfa:IDREF"])
+        self.assertEqual(refs, set(["Shape-0"]))
+
+    def test_stream(self):
+        Element.registry = {}
+        stream = XMLStream(BytesIO(self.data), "key:slide", set(["Shape-0"]))
+        ids = [slide.get("sfa:ID") for slide in stream]
+        self.assertEqual(ids, ["Slide-0", "Slide-1", "Slide-2"])
+        self.assertEqual(list(Element.registry.keys()), ["Shape-0"])
+        # referenced elements survive their slide being discarded
+        self.assertEqual(Element(Element.registry["Shape-0"]).shorttag, "sf:shape")
+        slide_list = stream.root.find("key:slide-list")
+        self.assertEqual(len(slide_list), 1)
+        self.assertEqual(len(slide_list[0]), 0)
+
+if __name__ == "__main__":
+    unittest.main()